@@ -6,10 +6,59 @@
 ''' Utilities used to compare 2 lisp files '''
 
 from lisp_utils import LispParser
+from parse_cache import ParseCache
 from utils import get_contents
+from multiprocessing import Pool
+import fnmatch
+import hashlib
+import json
 import sys
 import os
 
+# the parse cache named by the LISP_PARSE_CACHE environment variable, if any
+PARSE_CACHE = ParseCache.from_environment()
+
+class Edit(object):
+    '''One step of an edit script from LispDiff.diff_trees.
+    op is one of INSERT, DELETE, REPLACE.
+    path is the list of child positions from the baseline's root to:
+        - the deleted or replaced node, for DELETE and REPLACE
+        - the position the new node goes to (before the baseline child at that position), for INSERT
+    old is the baseline's subtree (None for INSERT), and new the generated one (None for DELETE).'''
+    
+    __slots__ = ("op", "path", "old", "new")
+    
+    INSERT = "insert"
+    DELETE = "delete"
+    REPLACE = "replace"
+    
+    # how many characters of a subtree to show
+    SHOW_CHARS = 60
+    
+    def __init__(self, op, path, old, new):
+        self.op = op
+        self.path = path
+        self.old = old
+        self.new = new
+        
+    @staticmethod
+    def _show(node):
+        '''Return a short, one-line version of the given subtree.'''
+        
+        if node is None:
+            return "-"
+        
+        text = " ".join(node._tokenize())
+        if len(text) > Edit.SHOW_CHARS:
+            text = text[:Edit.SHOW_CHARS - 3] + "..."
+        return text
+        
+    def __str__(self):
+        return "%s at %s: %s -> %s" % (self.op, self.path, Edit._show(self.old), Edit._show(self.new))
+        
+    def __repr__(self):
+        return "<Edit %s>" % self
+        
 class LispDiff(object):
     '''A Lisp-specific diff engine.
     Has some advantages over commercial diff engines:
@@ -22,6 +71,12 @@ class LispDiff(object):
     ALIGN_WINDOW = 2
     # how many shared tokens for a good alignment
     MATCH_WINDOW = 3
+    # past this many inserted + deleted children, the children of a node aren't aligned, and the node is replaced
+    MAX_CHILD_EDITS = 2000
+    # which files of a directory compare_dirs looks at
+    DIR_PATTERN = "*.lisp"
+    # how much of a file to hash at a time
+    HASH_CHUNK_SIZE = 1 << 20
 
     @staticmethod
     def compare(f_baseline, f_generated):
@@ -72,8 +127,277 @@ class LispDiff(object):
          
         return len_match and token_match
 
+    @staticmethod
+    def diff(f_baseline, f_generated):
+        '''Compare the given generated file to the baseline file, as trees. Return the edit script (see diff_trees).'''
+        
+        baseline_tree = LispParser.get_tree(get_contents(f_baseline), cache=PARSE_CACHE)
+        generated_tree = LispParser.get_tree(get_contents(f_generated), cache=PARSE_CACHE)
+        return LispDiff.diff_trees(baseline_tree, generated_tree)
+        
+    @staticmethod
+    def diff_trees(baseline_tree, generated_tree):
+        '''Return the edit script which turns the baseline tree into the generated one: a list of Edits, in document order.
+        Identical subtrees are skipped by fingerprint, so the time mostly depends on how much is different.
+        The children of a changed node are aligned with an O(ND) diff of their fingerprints.
+        An empty list means the trees are the same.'''
+        
+        edits = []
+        # pairs of (baseline node, generated node, path) which might differ
+        stack = [(baseline_tree, generated_tree, [])]
+        
+        while stack:
+            old, new, path = stack.pop()
+            
+            if old.fingerprint() == new.fingerprint():
+                continue
+            
+            if old.name != new.name or old.fn != new.fn:
+                edits.append(Edit(Edit.REPLACE, path, old, new))
+                continue
+            
+            old_children, new_children = old.children, new.children
+            ops = LispDiff._align([child.fingerprint() for child in old_children], [child.fingerprint() for child in new_children])
+            
+            if ops is None:
+                # too different to be worth aligning
+                edits.append(Edit(Edit.REPLACE, path, old, new))
+                continue
+            
+            # a run of deletes and inserts at the same place is a change to those children:
+            # pair them up, and look inside pairs with the same head
+            deleted, inserted = [], []
+            for op, i, j in ops + [(None, len(old_children), len(new_children))]:
+                if op == Edit.DELETE:
+                    deleted.append(i)
+                    continue
+                elif op == Edit.INSERT:
+                    inserted.append(j)
+                    continue
+                
+                for ii, jj in zip(deleted, inserted):
+                    old_child, new_child = old_children[ii], new_children[jj]
+                    if old_child.name == new_child.name and old_child.fn == new_child.fn:
+                        stack.append((old_child, new_child, path + [ii]))
+                    else:
+                        edits.append(Edit(Edit.REPLACE, path + [ii], old_child, new_child))
+                for ii in deleted[len(inserted):]:
+                    edits.append(Edit(Edit.DELETE, path + [ii], old_children[ii], None))
+                for jj in inserted[len(deleted):]:
+                    edits.append(Edit(Edit.INSERT, path + [i], None, new_children[jj]))
+                deleted, inserted = [], []
+        
+        # the paths sort in document order, and inserts keep their order
+        edits.sort(key=lambda edit: edit.path)
+        return edits
+        
+    @staticmethod
+    def _align(a, b):
+        '''Return the shortest edit script from sequence a to sequence b, with Myers' O(ND) algorithm,
+        as a list of (op, i, j), where op is None (a[i] == b[j]), Edit.DELETE (a[i]) or Edit.INSERT (b[j], before a[i]).
+        Return None if it takes more than MAX_CHILD_EDITS inserts and deletes.'''
+        
+        # the common prefix and suffix are the usual case, and cheap to skip
+        start = 0
+        while start < len(a) and start < len(b) and a[start] == b[start]:
+            start += 1
+        end_a, end_b = len(a), len(b)
+        while end_a > start and end_b > start and a[end_a - 1] == b[end_b - 1]:
+            end_a -= 1
+            end_b -= 1
+        
+        n, m = end_a - start, end_b - start
+        
+        # v[k] is the furthest x reached on diagonal k (y = x - k); trace has v before each round
+        v = {1: 0}
+        trace = []
+        
+        for d in xrange(n + m + 1):
+            if d > LispDiff.MAX_CHILD_EDITS:
+                return None
+            
+            trace.append(v.copy())
+            for k in xrange(-d, d + 1, 2):
+                if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                    x = v[k + 1]
+                else:
+                    x = v[k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[start + x] == b[start + y]:
+                    x += 1
+                    y += 1
+                v[k] = x
+                
+                if x >= n and y >= m:
+                    break
+            else:
+                continue
+            break
+        
+        # walk back from the end to find the path
+        middle = []
+        x, y = n, m
+        for d in xrange(len(trace) - 1, -1, -1):
+            v = trace[d]
+            k = x - y
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                prev_k = k + 1
+            else:
+                prev_k = k - 1
+            prev_x = v[prev_k]
+            prev_y = prev_x - prev_k
+            
+            while x > prev_x and y > prev_y:
+                x -= 1
+                y -= 1
+                middle.append((None, start + x, start + y))
+            
+            if d > 0:
+                if x == prev_x:
+                    middle.append((Edit.INSERT, start + x, start + y - 1))
+                else:
+                    middle.append((Edit.DELETE, start + x - 1, start + y))
+            x, y = prev_x, prev_y
+        
+        middle.reverse()
+        return [(None, i, i) for i in xrange(start)] + middle + \
+            [(None, end_a + i, end_b + i) for i in xrange(len(a) - end_a)]
+
+    @staticmethod
+    def file_digest(fname):
+        '''Return the sha1 (hex) of the contents of the given file, read a chunk at a time.'''
+        
+        h = hashlib.sha1()
+        fp = open(fname, "rb")
+        for chunk in iter(lambda: fp.read(LispDiff.HASH_CHUNK_SIZE), ""):
+            h.update(chunk)
+        fp.close()
+        return h.hexdigest()
+        
+    @staticmethod
+    def compare_files(f_baseline, f_generated):
+        '''Compare the given generated file to the baseline file, for compare_dirs. Return a dictionary with:
+            status - "identical" (same bytes), "equivalent" (same trees), "different" or "error"
+            passed - True iff the files are identical or equivalent
+        and for different files, edits (how many) and first_difference (the first edit: op, path, baseline and generated),
+        or for errors, error (the message).
+        Byte-identical files are found by size and hash, without tokenizing them.'''
+        
+        try:
+            if os.path.getsize(f_baseline) == os.path.getsize(f_generated) and \
+                    LispDiff.file_digest(f_baseline) == LispDiff.file_digest(f_generated):
+                return {"status" : "identical", "passed" : True}
+            
+            edits = LispDiff.diff(f_baseline, f_generated)
+        except Exception as e:
+            return {"status" : "error", "passed" : False, "error" : "%s: %s" % (type(e).__name__, e)}
+        
+        if not edits:
+            return {"status" : "equivalent", "passed" : True}
+        
+        first = edits[0]
+        return {
+            "status" : "different",
+            "passed" : False,
+            "edits" : len(edits),
+            "first_difference" : {
+                "op" : first.op,
+                "path" : first.path,
+                "baseline" : Edit._show(first.old) if first.old is not None else None,
+                "generated" : Edit._show(first.new) if first.new is not None else None
+            }
+        }
+        
+    @staticmethod
+    def compare_dirs(baseline_dir, generated_dir, processes=None, pattern=None):
+        '''Compare every file in generated_dir with the file of the same name in baseline_dir, on a pool of processes
+        (one per CPU by default). Only files matching pattern (DIR_PATTERN by default) are compared.
+        Return a summary dictionary, which can be written out as JSON:
+            baseline, generated - the directories
+            passed, failed - how many files passed and failed
+            files - a list with a dictionary per file: file (the name), and the result of compare_files.
+                Files which are only in one of the directories have status "missing" or "unexpected".'''
+        
+        pattern = pattern or LispDiff.DIR_PATTERN
+        
+        def list_files(directory):
+            return set(f for f in fnmatch.filter(os.listdir(directory), pattern) if os.path.isfile(os.path.join(directory, f)))
+        
+        baseline_files, generated_files = list_files(baseline_dir), list_files(generated_dir)
+        
+        pairs = [(os.path.join(baseline_dir, f), os.path.join(generated_dir, f)) for f in sorted(baseline_files & generated_files)]
+        
+        pool = Pool(processes)
+        try:
+            results = pool.map(_compare_pair, pairs, 1)
+        finally:
+            pool.close()
+            pool.join()
+        
+        files = []
+        for (f_baseline, f_generated), result in zip(pairs, results):
+            result["file"] = os.path.basename(f_baseline)
+            files.append(result)
+        for f in baseline_files - generated_files:
+            files.append({"file" : f, "status" : "missing", "passed" : False})
+        for f in generated_files - baseline_files:
+            files.append({"file" : f, "status" : "unexpected", "passed" : False})
+        
+        files.sort(key=lambda result: result["file"])
+        passed = sum(1 for result in files if result["passed"])
+        
+        return {
+            "baseline" : baseline_dir,
+            "generated" : generated_dir,
+            "passed" : passed,
+            "failed" : len(files) - passed,
+            "files" : files
+        }
+        
+def _compare_pair(pair):
+    '''Compare one (baseline file, generated file) pair in a worker process, see LispDiff.compare_dirs.'''
+    
+    return LispDiff.compare_files(*pair)
+    
+def dirs_main(args):
+    '''Compare two directories from the command line arguments: baseline_dir generated_dir [summary_file] [processes]
+    The JSON summary goes to summary_file, or stdout.'''
+    
+    usage = "usage: python compare.py --dirs baseline_dir generated_dir [summary_file] [processes]"
+    
+    if not 2 <= len(args) <= 4:
+        print >>sys.stderr, usage
+        sys.exit(1)
+    
+    for d in args[:2]:
+        if not os.path.isdir(d):
+            print >>sys.stderr, "Given directory does not exist: '%s'" % d
+            sys.exit(1)
+    
+    processes = int(args[3]) if len(args) == 4 else None
+    summary = LispDiff.compare_dirs(args[0], args[1], processes)
+    
+    if len(args) >= 3:
+        fp = open(args[2], "w")
+        json.dump(summary, fp, indent=2, sort_keys=True)
+        fp.close()
+        print "==> %d passed, %d failed, summary in %s" % (summary["passed"], summary["failed"], args[2])
+    else:
+        print json.dumps(summary, indent=2, sort_keys=True)
+    
+    sys.exit(1 if summary["failed"] else 0)
+
 if __name__ == "__main__":
-    usage = "python compare.py baseline_file generated_file"
+    if len(sys.argv) > 1 and sys.argv[1] == "--dirs":
+        dirs_main(sys.argv[2:])
+    
+    usage = "python compare.py [--tree] baseline_file generated_file\n" \
+        "       python compare.py --dirs baseline_dir generated_dir [summary_file] [processes]"
+    
+    # the tree diff, which prints an edit script
+    tree_mode = len(sys.argv) > 1 and sys.argv[1] == "--tree"
+    if tree_mode:
+        del sys.argv[1]
     
     if len(sys.argv) != 3:
         if len(sys.argv) < 3:
@@ -98,7 +422,16 @@ if __name__ == "__main__":
     
     diff_engine = LispDiff
     
-    if diff_engine.compare(f_baseline, f_generated):
+    if tree_mode:
+        edits = diff_engine.diff(f_baseline, f_generated)
+        for edit in edits:
+            print edit
+        
+        if edits:
+            print "ERROR: files are different (%d edits)" % len(edits)
+            sys.exit(1)
+        print "Files are identical"
+    elif diff_engine.compare(f_baseline, f_generated):
         print "Files are identical"
     else:
         print "ERROR: files are different"
@@ -0,0 +1,328 @@
+''' Evaluates PDDL conditions and effects: by walking their trees, or compiled into closures over bitset states '''
+
+from lisp_utils import Node
+from states import NUMERIC_EFFECTS, NUMERIC_COMPARISONS, typed_list, list_names, section_after, atom_names
+
+def _is_empty(node):
+	'''Return whether the given condition or effect is missing, or an empty ().'''
+
+	return node is None or (node.name == Node.EVAL_NAME and not node.children)
+
+def _ground(node, binding):
+	'''Return the ground atom (a tuple of names) of the given atom node, with its variables replaced by their binding.'''
+
+	return tuple([binding.get(name, name) for name in atom_names(node)])
+
+def _check_supported(node):
+	'''Raise ValueError if the given atom or (=) node of a condition is not supported:
+	a numeric comparison, or an expression like (fuel) as an argument.'''
+
+	if node.name in NUMERIC_COMPARISONS or any(child.fn for child in node.children):
+		raise ValueError("Unsupported condition: %s" % " ".join(node.to_lisp().split()))
+
+def _quantified(node, binding, types):
+	'''Generate the bindings of a forall / exists node: the given binding, plus a value for each of its variables.'''
+
+	variables = typed_list(list_names(node.children[0]))
+	choices = [types.objects_of(t) for _, t in variables]
+
+	def extend(i, binding):
+		if i == len(variables):
+			yield binding
+			return
+		for value in choices[i]:
+			inner = dict(binding)
+			inner[variables[i][0]] = value
+			for result in extend(i + 1, inner):
+				yield result
+
+	return extend(0, binding)
+
+def evaluate(node, state, binding, types):
+	'''Return whether the condition tree holds in the given state, by walking the tree (the reference evaluator).
+	state is anything with `atom in state` for atoms as tuples of names (a set, a FactStore ...),
+	binding maps variables to object names, and types is a states.TypedObjects, for the quantifiers.
+	Supports and, or, not, imply, forall, exists and = (between objects). Other conditions raise ValueError.'''
+
+	if _is_empty(node):
+		return True
+
+	name = node.name
+	if name == "and":
+		return all(evaluate(child, state, binding, types) for child in node.children)
+	if name == "or":
+		return any(evaluate(child, state, binding, types) for child in node.children)
+	if name == "not":
+		return not evaluate(node.children[0], state, binding, types)
+	if name == "imply":
+		return not evaluate(node.children[0], state, binding, types) or evaluate(node.children[1], state, binding, types)
+	if name == "forall":
+		return all(evaluate(node.children[1], state, inner, types) for inner in _quantified(node, binding, types))
+	if name == "exists":
+		return any(evaluate(node.children[1], state, inner, types) for inner in _quantified(node, binding, types))
+	_check_supported(node)
+	if name == "=":
+		return binding.get(node.children[0].name, node.children[0].name) == binding.get(node.children[1].name, node.children[1].name)
+	return _ground(node, binding) in state
+
+def apply_effect(node, state, binding, types):
+	'''Return the state (a set of atoms, as tuples of names) after the effect tree, by walking the tree (the reference).
+	The deletes are done before the adds, and the conditions of (when ...) are evaluated in the state before the effect.
+	Supports and, not, forall and when. Numeric effects are ignored.'''
+
+	add, delete = set(), set()
+
+	def collect(node, binding):
+		if _is_empty(node) or node.name in NUMERIC_EFFECTS:
+			return
+		if node.name == "and":
+			for child in node.children:
+				collect(child, binding)
+		elif node.name == "not":
+			delete.add(_ground(node.children[0], binding))
+		elif node.name == "forall":
+			for inner in _quantified(node, binding, types):
+				collect(node.children[1], inner)
+		elif node.name == "when":
+			if evaluate(node.children[0], state, binding, types):
+				collect(node.children[1], binding)
+		else:
+			add.add(_ground(node, binding))
+
+	collect(node, binding)
+	return (set(state) - delete) | add
+
+class ConditionCompiler(object):
+	'''Compiles condition and effect trees, for a binding of their variables, into closures over the bitset states
+	of an AtomCatalogue (see states.py):
+		- the quantifiers are expanded, the equalities decided, and negations pushed down to the atoms
+		- the atoms under an and (or an or) are merged into bitmasks, so most conditions are one or two int operations
+		- atoms which are not in the catalogue can never be true
+	A condition compiles to f(state) -> bool, and an effect to f(state) -> the next state.
+	Results match the reference evaluate and apply_effect.'''
+
+	def __init__(self, catalogue):
+		'''Compile for the states of the given AtomCatalogue.'''
+
+		self.catalogue = catalogue
+		self.types = catalogue.types
+
+	def _bit(self, node, binding):
+		'''Return the bitmask of the given atom node, or 0 if the atom is not in the catalogue.'''
+
+		bit = self.catalogue.bit(_ground(node, binding))
+		return 0 if bit is None else 1 << bit
+
+	def _normal(self, node, binding, positive):
+		'''Return the condition with the quantifiers expanded and the negations pushed to the atoms, as
+		True, False, ("atom", mask, positive), or ("and" / "or", list of those).
+		Raise ValueError for conditions which evaluate doesn't support either.'''
+
+		if _is_empty(node):
+			return positive
+
+		name = node.name
+		if name == "not":
+			return self._normal(node.children[0], binding, not positive)
+		if name == "and" or name == "or":
+			# a negated and is an or of the negations, and a negated or is an and
+			kind = name if positive else ("or" if name == "and" else "and")
+			return (kind, [self._normal(child, binding, positive) for child in node.children])
+		if name == "imply":
+			return ("or" if positive else "and", [self._normal(node.children[0], binding, not positive),
+				self._normal(node.children[1], binding, positive)])
+		if name == "forall" or name == "exists":
+			kind = "and" if (name == "forall") == positive else "or"
+			return (kind, [self._normal(node.children[1], inner, positive) for inner in _quantified(node, binding, self.types)])
+		_check_supported(node)
+		if name == "=":
+			left, right = [binding.get(child.name, child.name) for child in node.children]
+			return (left == right) == positive
+
+		mask = self._bit(node, binding)
+		if mask == 0:
+			# never true
+			return not positive
+		return ("atom", mask, positive)
+
+	def _build(self, item):
+		'''Return the closure for a condition from _normal.'''
+
+		if item is True:
+			return lambda state: True
+		if item is False:
+			return lambda state: False
+
+		kind = item[0]
+		if kind == "atom":
+			_, mask, positive = item
+			if positive:
+				return lambda state: state & mask != 0
+			return lambda state: state & mask == 0
+
+		# flatten nested ands (ors), and sort the parts into constants, atoms and the rest
+		parts = []
+		todo = list(item[1])
+		while todo:
+			part = todo.pop()
+			if isinstance(part, tuple) and part[0] == kind:
+				todo.extend(part[1])
+			else:
+				parts.append(part)
+
+		positive_mask = negative_mask = 0
+		rest = []
+		for part in parts:
+			if part is True or part is False:
+				if part == (kind == "or"):
+					# true in an or, false in an and: decides the whole thing
+					return self._build(part)
+			elif part[0] == "atom":
+				if part[2]:
+					positive_mask |= part[1]
+				else:
+					negative_mask |= part[1]
+			else:
+				rest.append(self._build(part))
+
+		if kind == "and":
+			if positive_mask & negative_mask:
+				# some atom has to be both true and false
+				return self._build(False)
+			all_of = positive_mask
+			if not rest:
+				if not negative_mask:
+					return lambda state: state & all_of == all_of
+				return lambda state: state & all_of == all_of and not state & negative_mask
+			def conjunction(state):
+				if state & all_of != all_of or state & negative_mask:
+					return False
+				for f in rest:
+					if not f(state):
+						return False
+				return True
+			return conjunction
+
+		if positive_mask & negative_mask:
+			# some atom is either true or false
+			return self._build(True)
+		any_of = positive_mask
+		if not rest:
+			if not negative_mask:
+				return lambda state: state & any_of != 0
+			return lambda state: state & any_of != 0 or state & negative_mask != negative_mask
+		def disjunction(state):
+			if state & any_of or state & negative_mask != negative_mask:
+				return True
+			for f in rest:
+				if f(state):
+					return True
+			return False
+		return disjunction
+
+	def condition(self, node, binding):
+		'''Return the closure f(state) -> bool for the given condition tree and binding (variable -> object name).'''
+
+		return self._build(self._normal(node, binding, True))
+
+	def _effect_masks(self, node, binding, masks, conditional):
+		'''Add the effect's atoms to masks ([add, delete]), and its (when ...) parts to conditional.'''
+
+		if _is_empty(node) or node.name in NUMERIC_EFFECTS:
+			return
+		name = node.name
+		if name == "and":
+			for child in node.children:
+				self._effect_masks(child, binding, masks, conditional)
+		elif name == "not":
+			masks[1] |= self._bit(node.children[0], binding)
+		elif name == "forall":
+			for inner in _quantified(node, binding, self.types):
+				self._effect_masks(node.children[1], inner, masks, conditional)
+		elif name == "when":
+			inner_masks = [0, 0]
+			inner_conditional = []
+			self._effect_masks(node.children[1], binding, inner_masks, inner_conditional)
+			if inner_conditional:
+				raise ValueError("Nested when in effect: %s" % node.to_lisp())
+			conditional.append((self.condition(node.children[0], binding), inner_masks[0], inner_masks[1]))
+		else:
+			atom = _ground(node, binding)
+			bit = self.catalogue.bit(atom)
+			if bit is None:
+				raise KeyError("Effect atom %s is not in the catalogue" % (atom, ))
+			masks[0] |= 1 << bit
+
+	def effect(self, node, binding):
+		'''Return the closure f(state) -> next state for the given effect tree and binding.
+		Like apply_effect, deletes come before adds, and conditions are evaluated in the state before the effect.'''
+
+		masks = [0, 0]
+		conditional = []
+		self._effect_masks(node, binding, masks, conditional)
+		add, delete = masks
+		keep = ~delete
+
+		if not conditional:
+			return lambda state: (state & keep) | add
+
+		def apply(state):
+			a, d = add, delete
+			for holds, when_add, when_delete in conditional:
+				if holds(state):
+					a |= when_add
+					d |= when_delete
+			return (state & ~d) | a
+		return apply
+
+class CompiledAction(object):
+	'''An action schema, whose precondition and effect are compiled for each tuple of arguments the first time
+	it's used (see ConditionCompiler), and kept for next time.'''
+
+	def __init__(self, action, compiler):
+		'''Compile the given :action subtree with the given ConditionCompiler.'''
+
+		self.name = action.get_action_name()
+		self.compiler = compiler
+		parameters = section_after(action, ":parameters")
+		self.parameters = [variable for variable, _ in typed_list(list_names(parameters))] if parameters is not None else []
+		self.precondition_tree = section_after(action, ":precondition")
+		self.effect_tree = section_after(action, ":effect")
+
+		# args -> precondition closure, and args -> effect closure
+		self._preconditions = {}
+		self._effects = {}
+
+	def binding(self, args):
+		'''Return the binding of the parameters to the given arguments (a tuple of object names).'''
+
+		if len(args) != len(self.parameters):
+			raise ValueError("Action %s takes %d arguments, not %d" % (self.name, len(self.parameters), len(args)))
+		return dict(zip(self.parameters, args))
+
+	def precondition(self, args):
+		'''Return the precondition closure for the given arguments (a tuple of object names).'''
+
+		f = self._preconditions.get(args)
+		if f is None:
+			f = self._preconditions[args] = self.compiler.condition(self.precondition_tree, self.binding(args))
+		return f
+
+	def effect(self, args):
+		'''Return the effect closure for the given arguments (a tuple of object names).
+		Only compiled when first needed: the effects of arguments which are never applicable may not be in the catalogue.'''
+
+		f = self._effects.get(args)
+		if f is None:
+			f = self._effects[args] = self.compiler.effect(self.effect_tree, self.binding(args))
+		return f
+
+	def applicable(self, state, args):
+		'''Return whether the action with the given arguments can be done in the given (bitset) state.'''
+
+		return self.precondition(args)(state)
+
+	def apply(self, state, args):
+		'''Return the state after the action with the given arguments (its precondition is not checked).'''
+
+		return self.effect(args)(state)
@@ -0,0 +1,199 @@
+''' An indexed store of ground facts, like the ones in the :init section of a PDDL problem '''
+
+from lisp_utils import SYMBOLS
+
+class FactStore(object):
+	'''A set of ground facts, like (at ball1 rooma) or (free left).
+	Every fact is stored once, as a tuple of the SYMBOLS ids of its names: (predicate, arg1, arg2 ...).
+	The facts are indexed by predicate, and by (predicate, argument position, value), so that:
+		- membership tests are a single set lookup
+		- a pattern lookup, like (at ball1 ?), only touches the facts which can match
+	The argument indexes are only built for the (predicate, position) pairs which are looked up,
+	so a big initial state doesn't pay for indexes it never uses.
+	The API takes and returns tuples of names; the *_ids methods take and return tuples of ids.'''
+
+	def __init__(self, facts=()):
+		'''Create a store with the given facts (tuples of names).'''
+
+		# every fact, as a tuple of ids
+		self.facts = set()
+		# predicate id -> list of its facts, in the order they were added
+		self._by_predicate = {}
+		# (predicate id, argument position) -> {argument id -> list of facts}, built on demand by _argument_index
+		self._by_argument = {}
+		# the elements of the tree which are not atomic facts, like (= (total-cost) 0)
+		self.others = []
+
+		for fact in facts:
+			self.add(fact)
+
+	@staticmethod
+	def from_tree(init_tree):
+		'''Return a store with the facts which are the children of the given tree (like the :init subtree).
+		Children with nested expressions (numeric fluents, negations ...) are kept in others instead.'''
+
+		store = FactStore()
+		facts = store.facts
+		by_predicate = store._by_predicate
+		ids = SYMBOLS.ids
+		id_of = SYMBOLS.id_of
+
+		for child in init_tree.children:
+			args = child.children
+			if not child.fn or any(arg.fn for arg in args):
+				store.others.append(child)
+				continue
+
+			names = [child.name]
+			names.extend(arg.name for arg in args)
+			try:
+				fact = tuple([ids[name] for name in names])
+			except KeyError:
+				# not from a parsed tree, so some names are new
+				fact = tuple([id_of(name) for name in names])
+
+			if fact in facts:
+				continue
+			facts.add(fact)
+			facts_of = by_predicate.get(fact[0])
+			if facts_of is None:
+				by_predicate[fact[0]] = [fact]
+			else:
+				facts_of.append(fact)
+
+		return store
+
+	def __len__(self):
+		return len(self.facts)
+
+	def __iter__(self):
+		'''Iterate over the facts, as tuples of names, grouped by predicate.'''
+
+		decode = FactStore.decode
+		for facts in self._by_predicate.itervalues():
+			for fact in facts:
+				yield decode(fact)
+
+	def __contains__(self, fact):
+		'''Return whether the given fact (a tuple of names) is in the store.'''
+
+		fact = FactStore.encode(fact)
+		return fact is not None and fact in self.facts
+
+	@staticmethod
+	def encode(fact):
+		'''Return the tuple of ids for the given tuple of names, or None if a name was never seen (so no store has the fact).'''
+
+		ids = SYMBOLS.ids
+		try:
+			return tuple([ids[name] for name in fact])
+		except KeyError:
+			return None
+
+	@staticmethod
+	def decode(fact):
+		'''Return the tuple of names for the given tuple of ids.'''
+
+		names = SYMBOLS.names
+		return tuple([names[i] for i in fact])
+
+	def add(self, fact):
+		'''Add the given fact (a tuple of names). Return whether it is new.'''
+
+		return self.add_ids(tuple([SYMBOLS.id_of(name) for name in fact]))
+
+	def add_ids(self, fact):
+		'''Add the given fact (a tuple of ids). Return whether it is new.'''
+
+		if fact in self.facts:
+			return False
+
+		self.facts.add(fact)
+		self._by_predicate.setdefault(fact[0], []).append(fact)
+
+		# keep the argument indexes which were already built up to date
+		for pos in xrange(len(fact) - 1):
+			index = self._by_argument.get((fact[0], pos))
+			if index is not None:
+				index.setdefault(fact[pos + 1], []).append(fact)
+		return True
+
+	def has_ids(self, fact):
+		'''Return whether the given fact (a tuple of ids) is in the store.'''
+
+		return fact in self.facts
+
+	def predicates(self):
+		'''Return the names of the predicates which have facts.'''
+
+		return [SYMBOLS.names[p] for p in self._by_predicate]
+
+	def count(self, predicate):
+		'''Return how many facts the given predicate (a name) has.'''
+
+		p = SYMBOLS.ids.get(predicate)
+		return len(self._by_predicate.get(p, ()))
+
+	def count_ids(self, p):
+		'''Return how many facts the given predicate (an id) has.'''
+
+		return len(self._by_predicate.get(p, ()))
+
+	def _argument_index(self, p, pos):
+		'''Return the index of predicate id p's facts by their argument at position pos: {argument id -> list of facts}.'''
+
+		index = self._by_argument.get((p, pos))
+		if index is None:
+			index = self._by_argument[(p, pos)] = {}
+			k = pos + 1
+			for fact in self._by_predicate.get(p, ()):
+				if len(fact) > k:
+					facts_of = index.get(fact[k])
+					if facts_of is None:
+						index[fact[k]] = [fact]
+					else:
+						facts_of.append(fact)
+		return index
+
+	def match_ids(self, pattern):
+		'''Return the list of facts (tuples of ids) which match the given pattern.
+		The pattern is a tuple of ids, (predicate, arg1, arg2 ...), where an argument of None matches anything.'''
+
+		p = pattern[0]
+		bound = [(pos, arg) for pos, arg in enumerate(pattern[1:]) if arg is not None]
+		n = len(pattern)
+
+		if len(bound) == n - 1:
+			return [pattern] if pattern in self.facts else []
+
+		if not bound:
+			return [fact for fact in self._by_predicate.get(p, ()) if len(fact) == n]
+
+		# start from the most selective bound argument, and check the others on its facts
+		candidates = None
+		for pos, arg in bound:
+			facts_of = self._argument_index(p, pos).get(arg, ())
+			if candidates is None or len(facts_of) < len(candidates):
+				candidates = facts_of
+				if not candidates:
+					return []
+
+		return [fact for fact in candidates if len(fact) == n and all(fact[pos + 1] == arg for pos, arg in bound)]
+
+	def match(self, pattern):
+		'''Return the list of facts (tuples of names) which match the given pattern.
+		The pattern is a tuple of names, like ("at", "ball1", None), where None matches anything.'''
+
+		ids = SYMBOLS.ids
+		encoded = []
+		for name in pattern:
+			if name is None:
+				encoded.append(None)
+			else:
+				i = ids.get(name)
+				if i is None:
+					return []
+				encoded.append(i)
+
+		decode = FactStore.decode
+		return [decode(fact) for fact in self.match_ids(tuple(encoded))]
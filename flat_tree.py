@@ -0,0 +1,470 @@
+'''An alternative tree backend for very large lisp files.
+The whole tree lives in a few parallel arrays, with one entry per node, instead of one Python object per node.
+FlatNode is a lightweight view into those arrays, with the same API as lisp_utils.Node.'''
+
+from array import array
+from lisp_utils import Node, LispParser, SYMBOLS, iter_lisp, write_lisp, subtree_digest
+import mmap
+
+class FlatTree(object):
+	'''A DOM-like lisp tree stored as parallel arrays (struct-of-arrays).
+	Node i of the tree is described by:
+		names[i] - the id of the node's name in the symbol table (lisp_utils.SYMBOLS by default)
+		fn[i] - 1 iff the node is a function, same as Node.fn
+		parents[i], first_child[i], last_child[i], next_sibling[i] - indexes of the linked nodes, or NONE
+	Node 0 is the root.'''
+
+	NONE = -1
+
+	# whether every name of the tree is in the symbol table, so that a name which isn't can't match any node
+	NAMES_INTERNED = True
+
+	def __init__(self, view_class=None, symbols=None):
+		'''Create a new tree, which only has the root node.
+		view_class is the type of the views handed out for the nodes, FlatNode by default.
+		symbols is the lisp_utils.SymbolTable for the names. By default, it's the one shared by the whole session.'''
+
+		self.names = array("i")
+		self.fn = bytearray()
+		self.parents = array("i")
+		self.first_child = array("i")
+		self.last_child = array("i")
+		self.next_sibling = array("i")
+
+		self.symbols = symbols or SYMBOLS
+
+		self.view_class = view_class or FlatNode
+		self.new_node(Node.ROOT_NAME, False)
+
+	def __len__(self):
+		'''Return the number of nodes in the tree, including the root and any unattached nodes.'''
+
+		return len(self.fn)
+
+	def new_node(self, name, fn=False):
+		'''Create a new, unattached node. Return its index.'''
+
+		self._add_name(name)
+		self.fn.append(1 if fn else 0)
+		self.parents.append(FlatTree.NONE)
+		self.first_child.append(FlatTree.NONE)
+		self.last_child.append(FlatTree.NONE)
+		self.next_sibling.append(FlatTree.NONE)
+		return len(self.fn) - 1
+
+	def _add_name(self, name):
+		'''Store the name of a new node.'''
+
+		self.names.append(self.symbols.id_of(name))
+
+	def rename(self, i, name):
+		'''Change the name of node i.'''
+
+		self.names[i] = self.symbols.id_of(name)
+
+	def name_of(self, i):
+		'''Return the name of node i.'''
+
+		return self.symbols.names[self.names[i]]
+
+	def name_id(self, i):
+		'''Return the id of the name of node i in the symbol table.'''
+
+		return self.names[i]
+
+	def lookup_id(self, name):
+		'''Return the id of the given name in the symbol table, or None if no node can have that name.'''
+
+		return self.symbols.ids.get(name)
+
+	def make_node(self, name, fn=False):
+		'''Create a new, unattached node. Return a view of it.
+		Has the same signature as the Node constructor, so it can be handed to the tree builder.'''
+
+		return self.view_class(self, self.new_node(name, fn))
+
+	def view(self, i):
+		'''Return a view of node i. Return None for FlatTree.NONE.'''
+
+		if i == FlatTree.NONE:
+			return None
+		return self.view_class(self, i)
+
+	def root(self):
+		'''Return a view of the root node.'''
+
+		return self.view_class(self, 0)
+
+	def child_indexes(self, i):
+		'''Return a generator over the indexes of the children of node i.'''
+
+		child = self.first_child[i]
+		while child != FlatTree.NONE:
+			yield child
+			child = self.next_sibling[child]
+
+	def link(self, parent, child, index=None):
+		'''Attach the unattached node child to node parent.
+		If index is unspecified, make it the last child. Otherwise, put it *after* the given index, like Node.add_child.'''
+
+		self.parents[child] = parent
+
+		if index is not None and self.first_child[parent] != FlatTree.NONE:
+			if index < 0:
+				self.next_sibling[child] = self.first_child[parent]
+				self.first_child[parent] = child
+				return
+
+			# walk to the child at index once; past the last child, append
+			prev = self.first_child[parent]
+			for _ in xrange(index):
+				prev = self.next_sibling[prev]
+				if prev == FlatTree.NONE:
+					break
+			if prev != FlatTree.NONE and prev != self.last_child[parent]:
+				self.next_sibling[child] = self.next_sibling[prev]
+				self.next_sibling[prev] = child
+				return
+
+		if self.last_child[parent] == FlatTree.NONE:
+			self.first_child[parent] = self.last_child[parent] = child
+		else:
+			self.next_sibling[self.last_child[parent]] = child
+			self.last_child[parent] = child
+
+	def copy_subtree(self, node):
+		'''Copy the given subtree into this tree. Return the index of the (unattached) copy.
+		The subtree can come from any backend: a Node, or a FlatNode of any tree (including this one).'''
+
+		top = self.new_node(node.name, node.fn)
+		# pairs of (original node, index of its copy) whose children still need copying.
+		# The children are listed before any copy is linked, so copying a subtree into itself terminates.
+		stack = [(node.children, top)]
+
+		while stack:
+			children, parent = stack.pop()
+			for child in children:
+				grandchildren = child.children
+				copy = self.new_node(child.name, child.fn)
+				self.link(parent, copy)
+				if grandchildren:
+					stack.append((grandchildren, copy))
+
+		return top
+
+class MappedTree(FlatTree):
+	'''A FlatTree for a memory-mapped file, which is never read into a Python string.
+	Instead of name ids, the nodes have spans (offsets[i], lengths[i]) into the mapped file,
+	and a name only becomes a string when it is read.
+	Names which are not in the file (like Node.EVAL_NAME) are stored as -1 - (their id in the symbol table).'''
+
+	# names of the file only get into the symbol table when they are read,
+	# so a node can have a name for which lookup_id gives None
+	NAMES_INTERNED = False
+
+	def __init__(self, fname, view_class=None, symbols=None):
+		'''Map the given file, and create a new tree for it, which only has the root node.'''
+
+		self.offsets = array("l")
+		self.lengths = array("i")
+
+		self.fp = open(fname, "rb")
+		try:
+			self.buf = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+		except ValueError:
+			# empty files can't be mapped
+			self.buf = ""
+
+		FlatTree.__init__(self, view_class, symbols)
+
+	def close(self):
+		'''Unmap the file. The tree's names can't be read after this.'''
+
+		if isinstance(self.buf, mmap.mmap):
+			self.buf.close()
+		self.fp.close()
+
+	def iter_tokens(self):
+		'''Return a generator over the tokens of the mapped file.
+		Parens are the strings "(" and ")", and every other token is a (start, end) span of the file.'''
+
+		buf = self.buf
+		for match in LispParser._TOKEN_RE.finditer(buf):
+			start, end = match.span(1)
+			if start < 0:
+				# a comment
+				continue
+			if end - start == 1 and buf[start] in "()":
+				yield buf[start]
+			else:
+				yield (start, end)
+
+	def _add_name(self, name):
+		'''Store the name of a new node: a (start, end) span of the file, or a string.'''
+
+		if isinstance(name, tuple):
+			start, end = name
+			self.offsets.append(start)
+			self.lengths.append(end - start)
+		else:
+			self.offsets.append(-1 - self.symbols.id_of(name))
+			self.lengths.append(0)
+
+	def rename(self, i, name):
+		'''Change the name of node i. The new name is not in the file, so it's stored like Node.EVAL_NAME.'''
+
+		self.offsets[i] = -1 - self.symbols.id_of(name)
+		self.lengths[i] = 0
+
+	def name_of(self, i):
+		'''Return the name of node i, read from the mapped file.'''
+
+		offset = self.offsets[i]
+		if offset < 0:
+			return self.symbols.names[-1 - offset]
+
+		name = self.buf[offset : offset + self.lengths[i]]
+		if ";" in name:
+			# an atom which was glued across a comment
+			name = LispParser._GLUED_COMMENT_RE.sub("", name)
+		return self.symbols.intern(name)
+
+	def name_id(self, i):
+		'''Return the id of the name of node i in the symbol table.'''
+
+		offset = self.offsets[i]
+		if offset < 0:
+			return -1 - offset
+		return self.symbols.id_of(self.name_of(i))
+
+class FlatNode(object):
+	'''A view of one node of a FlatTree. Has the same API as lisp_utils.Node.
+	Views are cheap and made on demand, so two views of the same node are equal, but not identical.
+	Note that children is a fresh list every time: use add_child to change the tree.'''
+
+	__slots__ = ("tree", "i")
+
+	def __init__(self, tree, i):
+		'''Create a view of node i of the given FlatTree.'''
+
+		self.tree = tree
+		self.i = i
+
+	def __eq__(self, other):
+		return isinstance(other, FlatNode) and self.tree is other.tree and self.i == other.i
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __hash__(self):
+		return hash((id(self.tree), self.i))
+
+	@property
+	def hash(self):
+		'''A unique id for this node, which could be used in a tree.'''
+
+		return self.__hash__()
+
+	@property
+	def name(self):
+		return self.tree.name_of(self.i)
+
+	@name.setter
+	def name(self, fname):
+		self.tree.rename(self.i, fname)
+
+	@property
+	def fn(self):
+		return bool(self.tree.fn[self.i])
+
+	@property
+	def parent(self):
+		return self.tree.view(self.tree.parents[self.i])
+
+	@property
+	def children(self):
+		view = self.tree.view
+		return [view(child) for child in self.tree.child_indexes(self.i)]
+
+	def is_root(self):
+		'''Return True iff the current node is the root of the tree.'''
+
+		return self.name == Node.ROOT_NAME
+
+	def add_child(self, node, index=None):
+		'''Add the given node (or subtree) as a child of the current tree (node).
+		If index is unspecified, put it at the *END* of the child list (i.e. append).
+		If index is specified, put it *after* the given index.
+		Nodes from other trees (or already in this one) are copied in, since an array slot can only have one parent.'''
+
+		tree = self.tree
+
+		if isinstance(node, FlatNode) and node.tree is tree and tree.parents[node.i] == FlatTree.NONE and node.i != 0:
+			child = node.i
+		else:
+			child = tree.copy_subtree(node)
+
+		tree.link(self.i, child, index)
+
+	def index_of(self, subtree):
+		'''Return the index of the given subtree.
+		Return False if not found'''
+
+		for i, child in enumerate(self.tree.child_indexes(self.i)):
+			if subtree == self.tree.view(child):
+				return i
+		return False
+
+	def merge_tree(self, tree):
+		'''Slightly different from add_child because this is a fully-formed tree.
+		Procedure is to remove the root node, then add everything'''
+
+		if tree.is_root():
+			for child in tree.children:
+				self.add_child(child)
+		else:
+			self.add_child(tree)
+
+	def copy(self):
+		'''Return a deep copy of this subtree, in a new FlatTree with the same view class and symbol table.'''
+		
+		tree = FlatTree(self.tree.view_class, self.tree.symbols)
+		
+		if self.is_root():
+			tree.root().merge_tree(self)
+			return tree.root()
+		return tree.view(tree.copy_subtree(self))
+		
+	def freeze(self):
+		'''Same API as Node.freeze, but does nothing: add_child copies subtrees into the arrays anyway. Return this node.'''
+		
+		return self
+		
+	def walk(self):
+		'''Return a generator over (node, parent) for every node of this subtree, in document order, like Node.walk.'''
+		
+		stack = [(self, None)]
+		
+		while stack:
+			node, parent = stack.pop()
+			yield node, parent
+			
+			children = node.children
+			children.reverse()
+			stack.extend([(child, node) for child in children])
+		
+	def fingerprint(self):
+		'''Return the structural fingerprint of this subtree, the same as Node.fingerprint.
+		Flat trees have nowhere to keep it, so it's computed every time.'''
+		
+		tree = self.tree
+		# node index -> fingerprint
+		digests = {}
+		stack = [(self.i, False)]
+		
+		while stack:
+			i, ready = stack.pop()
+			children = list(tree.child_indexes(i))
+			
+			if ready or not children:
+				digests[i] = subtree_digest(tree.name_of(i), tree.fn[i], [digests[child] for child in children])
+			else:
+				stack.append((i, True))
+				stack.extend([(child, False) for child in children])
+		
+		return digests[self.i]
+		
+	def structurally_equal(self, other):
+		'''Return True iff the given subtree (of any backend) has the same names and shape as this one.'''
+		
+		return self.fingerprint() == other.fingerprint()
+		
+	def _matching_children(self, stop):
+		'''Return a generator over the indexes of the children matching the path step.'''
+
+		tree = self.tree
+
+		if isinstance(stop, tuple):
+			stop, i = stop
+			assert i >= 0
+		else:
+			i = None
+
+		name_id = tree.lookup_id(stop)
+		if name_id is None:
+			if tree.NAMES_INTERNED:
+				return
+			# none of the names read so far, so compare the names themselves
+			matches = lambda child: tree.name_of(child) == stop
+		else:
+			matches = lambda child: tree.name_id(child) == name_id
+
+		j = 0
+		for child in tree.child_indexes(self.i):
+			if matches(child):
+				if i is None:
+					yield child
+				elif i == j:
+					yield child
+					return
+				else:
+					j += 1
+
+	def seek_all(self, path):
+		'''Return *a generator* over the subtrees found.'''
+
+		if len(path) == 0:
+			yield self
+			return
+
+		for child in self._matching_children(path[0]):
+			for item in self.tree.view(child).seek_all(path[1:]):
+				yield item
+
+	def seek_all_list(self, path):
+		'''Return *a list* of the subtrees found, like Node.seek_all_list.'''
+
+		if len(path) == 0:
+			return
+
+		return list(self.seek_all(path))
+
+	def seek(self, path):
+		'''Return subtree if found, False otherwise.
+		Return first match. The path looks like the one for Node.seek.'''
+
+		for item in self.seek_all(path):
+			return item
+		return False
+
+	def seek_trail(self, path):
+		'''Like seek, but return the list of nodes from this one down to the match (both included), False if not found.'''
+		
+		if len(path) == 0:
+			return [self]
+		
+		for child in self._matching_children(path[0]):
+			trail = self.tree.view(child).seek_trail(path[1:])
+			if trail:
+				return [self] + trail
+		return False
+		
+	def print_tree(self, indent=0):
+		'''Print ASCII horizontal representation of the tree, like Node.print_tree.'''
+
+		# pairs of (node, indent), without recursion, since flat trees can be very deep
+		stack = [(self, indent)]
+		while stack:
+			node, indent = stack.pop()
+			print ("|---" * indent) + node.name
+			stack.extend((child, indent + 1) for child in reversed(node.children))
+
+	def to_lisp(self, indent=0):
+		'''Convert this tree to lisp expressions. Same output as Node.to_lisp.'''
+
+		return "".join(iter_lisp(self, indent))
+
+	def write_lisp(self, fp, indent=0):
+		'''Write this tree as lisp expressions to the given file object, a bit at a time. Same output as Node.write_lisp.'''
+
+		write_lisp(self, fp, indent)
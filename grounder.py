@@ -0,0 +1,361 @@
+''' Grounds the action schemas of a PDDL domain for a problem, only making the reachable ground actions '''
+
+from lisp_utils import SYMBOLS
+from fact_store import FactStore
+from states import AtomCatalogue, TypedObjects, OBJECT_TYPE, NUMERIC_EFFECTS, NUMERIC_COMPARISONS
+from states import typed_list, list_names, section_after, atom_names, conjuncts
+import itertools
+import time
+
+class ActionSchema(object):
+	'''An action schema of a domain, read from its :action subtree.
+	Atoms are (predicate id, terms), and every term is (variable index, None) or (None, constant id).
+	Only conjunctions of literals (and (in)equalities between objects) are supported: other conditions and effects,
+	like numeric comparisons or a negated and, raise ValueError.'''
+
+	# connectives which can't be in a literal
+	CONNECTIVES = ("and", "or", "imply", "forall", "exists", "not", "when")
+
+	def __init__(self, action):
+		'''Read the given :action subtree.'''
+
+		self.name = action.get_action_name()
+
+		parameters = section_after(action, ":parameters")
+		# list of (variable, type)
+		self.parameters = typed_list(list_names(parameters)) if parameters is not None else []
+		self.variables = dict((variable, i) for i, (variable, _) in enumerate(self.parameters))
+
+		self.preconditions = []
+		self.negative_preconditions = []
+		# pairs of variable indexes (or constants ids, see _term) which must be equal, or different
+		self.equal = []
+		self.different = []
+		self._read_precondition(section_after(action, ":precondition"))
+
+		self.add = []
+		self.delete = []
+		self._read_effect(section_after(action, ":effect"))
+
+	def _term(self, name):
+		'''Return the term for the given argument name.'''
+
+		if name.startswith("?"):
+			if name not in self.variables:
+				raise ValueError("Action %s uses %s, which is not a parameter" % (self.name, name))
+			return (self.variables[name], None)
+		return (None, SYMBOLS.id_of(name))
+
+	def _atom(self, node):
+		'''Return the atom for the given atom node.'''
+
+		names = atom_names(node)
+		return (SYMBOLS.id_of(names[0]), [self._term(name) for name in names[1:]])
+
+	@staticmethod
+	def _is_literal(literal):
+		'''Return whether the given (not ...) or positive part of a condition or effect is an atom or an (in)equality,
+		whose arguments are all names: no connectives, numeric comparisons, or nested expressions like (fuel).'''
+
+		if literal.name == "not":
+			if len(literal.children) != 1:
+				return False
+			literal = literal.children[0]
+		return literal.name not in ActionSchema.CONNECTIVES and literal.name not in NUMERIC_COMPARISONS \
+			and not any(child.fn for child in literal.children)
+
+	def _read_precondition(self, node):
+		'''Sort the literals of the precondition into positive and negative atoms, and (in)equalities.'''
+
+		for literal in conjuncts(node):
+			if not ActionSchema._is_literal(literal):
+				raise ValueError("Action %s has an unsupported precondition: %s" % (self.name, literal.to_lisp()))
+
+			negative = literal.name == "not"
+			if negative:
+				literal = literal.children[0]
+
+			if literal.name == "=":
+				pair = tuple(self._term(child.name) for child in literal.children)
+				(self.different if negative else self.equal).append(pair)
+			else:
+				(self.negative_preconditions if negative else self.preconditions).append(self._atom(literal))
+
+	def _read_effect(self, node):
+		'''Sort the literals of the effect into add and delete atoms.'''
+
+		for literal in conjuncts(node):
+			if literal.name in NUMERIC_EFFECTS:
+				continue
+			if not ActionSchema._is_literal(literal) or literal.name == "=":
+				raise ValueError("Action %s has an unsupported effect: %s" % (self.name, literal.to_lisp()))
+
+			negative = literal.name == "not"
+			if negative:
+				literal = literal.children[0]
+			(self.delete if negative else self.add).append(self._atom(literal))
+
+class GroundAction(object):
+	'''An instance of an action schema. The atoms are tuples of SYMBOLS ids, see FactStore.'''
+
+	__slots__ = ("schema", "args", "preconditions", "negative_preconditions", "add", "delete")
+
+	def __init__(self, schema, args):
+		'''Instantiate the given schema with the given arguments (a tuple of ids, one per parameter).'''
+
+		self.schema = schema
+		self.args = args
+		self.preconditions = [Grounder.ground_atom(atom, args) for atom in schema.preconditions]
+		self.negative_preconditions = [Grounder.ground_atom(atom, args) for atom in schema.negative_preconditions]
+		self.add = [Grounder.ground_atom(atom, args) for atom in schema.add]
+		self.delete = [Grounder.ground_atom(atom, args) for atom in schema.delete]
+
+	def __str__(self):
+		'''Return the action like it's written in a plan, e.g. (pick ball1 rooma left).'''
+
+		return "(%s)" % " ".join([self.schema.name] + [SYMBOLS.names[arg] for arg in self.args])
+
+class SchemaStats(object):
+	'''What grounding did for one action schema.'''
+
+	__slots__ = ("naive", "grounded", "seconds")
+
+	def __init__(self, naive):
+		# how many actions grounding over every object of the right types would make
+		self.naive = naive
+		self.grounded = 0
+		self.seconds = 0.0
+
+	def pruned(self):
+		'''Return how many of the naive ground actions were left out.'''
+
+		return self.naive - self.grounded
+
+class Grounder(object):
+	'''Grounds the action schemas of a domain for a problem, with a relaxed reachability analysis:
+		- starting from :init, an action is made once all its positive preconditions can be reached
+		  (negative preconditions and deletes are ignored, except for static predicates, which never change)
+		- its add effects are then reachable, which can make more actions, until nothing new is reached
+	The preconditions are instantiated by joining them against the reached facts (an indexed FactStore),
+	starting with the most selective ones (static predicates, bound arguments), so the objects of the problem
+	are never enumerated blindly. After the first round, only joins that use a newly reached fact are done.
+	Parameters which are in no positive precondition range over the objects of their type.'''
+
+	def __init__(self, domain_tree, problem_tree):
+		'''Read the action schemas of the domain, and the objects and initial state of the problem.'''
+
+		self.domain_tree = domain_tree
+		self.problem_tree = problem_tree
+		self.schemas = [ActionSchema(action) for action in domain_tree.get_actions()]
+		self.types = TypedObjects(domain_tree, problem_tree)
+
+		fluent = set(atom[0] for schema in self.schemas for atom in schema.add + schema.delete)
+		self.static = set(predicate for schema in self.schemas
+			for predicate, _ in schema.preconditions + schema.negative_preconditions if predicate not in fluent)
+
+		# the reachable facts (so far)
+		self.reached = FactStore()
+		for fact in problem_tree.get_facts().facts:
+			self.reached.add_ids(fact)
+
+		# schema name -> SchemaStats, filled in by ground
+		self.stats = {}
+		# how long the last grounding took
+		self.seconds = 0.0
+
+	@staticmethod
+	def ground_atom(atom, args):
+		'''Return the ground atom (a tuple of ids) for the given schema atom and arguments (ids, by variable index).'''
+
+		predicate, terms = atom
+		return (predicate,) + tuple([c if v is None else args[v] for v, c in terms])
+
+	def _candidates(self, schema):
+		'''Return, for every parameter of the schema, the set of ids of the objects of its type (None for any object).'''
+
+		candidates = []
+		for _, t in schema.parameters:
+			if t == OBJECT_TYPE:
+				candidates.append(None)
+			else:
+				candidates.append(set(SYMBOLS.id_of(name) for name in self.types.objects_of(t)))
+		return candidates
+
+	def _order(self, schema, first):
+		'''Return the positive preconditions of the schema in the order to join them, starting with the given one (or None).
+		Next is always the one with the fewest unbound variables, static predicates first, then the rarest predicate.'''
+
+		remaining = list(schema.preconditions)
+		order = []
+		bound = set()
+		if first is not None:
+			remaining.remove(first)
+			order.append(first)
+			bound.update(v for v, _ in first[1] if v is not None)
+
+		while remaining:
+			def cost(atom):
+				unbound = len(set(v for v, _ in atom[1] if v is not None and v not in bound))
+				return (unbound, atom[0] not in self.static, self.reached.count_ids(atom[0]))
+			atom = min(remaining, key=cost)
+			remaining.remove(atom)
+			order.append(atom)
+			bound.update(v for v, _ in atom[1] if v is not None)
+		return order
+
+	def _join(self, order, stores, candidates, args):
+		'''Generate the arguments (lists of ids, None for unbound variables) which satisfy every atom of order,
+		each one matched against the FactStore at the same position in stores. args is changed in place.'''
+
+		if not order:
+			yield args
+			return
+
+		predicate, terms = order[0]
+		pattern = [predicate]
+		for v, c in terms:
+			pattern.append(c if v is None else args[v])
+
+		for fact in stores[0].match_ids(tuple(pattern)):
+			# the variables this fact binds, to unbind them afterwards
+			newly_bound = []
+			ok = True
+			for k, (v, c) in enumerate(terms):
+				if v is None:
+					continue
+				value = fact[k + 1]
+				if args[v] is None:
+					allowed = candidates[v]
+					if allowed is not None and value not in allowed:
+						ok = False
+						break
+					args[v] = value
+					newly_bound.append(v)
+				elif args[v] != value:
+					# the same variable twice in the atom, with different values
+					ok = False
+					break
+
+			if ok:
+				for result in self._join(order[1:], stores[1:], candidates, args):
+					yield result
+			for v in newly_bound:
+				args[v] = None
+
+	def _complete(self, schema, candidates, args):
+		'''Generate the ground argument tuples for the given partial arguments: the unbound parameters range over their
+		type's objects, and the (in)equalities and static negative preconditions are checked.'''
+
+		unbound = [v for v, value in enumerate(args) if value is None]
+		all_objects = None
+		choices = []
+		for v in unbound:
+			if candidates[v] is not None:
+				choices.append(sorted(candidates[v]))
+			else:
+				if all_objects is None:
+					all_objects = [SYMBOLS.id_of(name) for name, _ in self.types.objects]
+				choices.append(all_objects)
+
+		initial = self.problem_tree.get_facts()
+		for values in itertools.product(*choices):
+			for v, value in zip(unbound, values):
+				args[v] = value
+			ground = tuple(args)
+
+			def value_of(term):
+				return term[1] if term[0] is None else ground[term[0]]
+
+			if any(value_of(a) != value_of(b) for a, b in schema.equal):
+				continue
+			if any(value_of(a) == value_of(b) for a, b in schema.different):
+				continue
+			if any(atom[0] in self.static and initial.has_ids(Grounder.ground_atom(atom, ground))
+					for atom in schema.negative_preconditions):
+				continue
+			yield ground
+
+		for v in unbound:
+			args[v] = None
+
+	def ground(self):
+		'''Generate the reachable ground actions (GroundActions), each once, as they are found.
+		stats and seconds are up to date once the generator is done.'''
+
+		start = time.time()
+		candidates = dict((schema.name, self._candidates(schema)) for schema in self.schemas)
+		self.stats = {}
+		for schema in self.schemas:
+			naive = 1
+			for allowed in candidates[schema.name]:
+				naive *= len(self.types.objects) if allowed is None else len(allowed)
+			self.stats[schema.name] = SchemaStats(naive)
+
+		# schema name -> the argument tuples which were made
+		made = dict((schema.name, set()) for schema in self.schemas)
+		# the facts reached in the last round (all of :init for the first one)
+		delta = self.reached
+		first_round = True
+
+		while True:
+			new_facts = []
+			for schema in self.schemas:
+				schema_start = time.time()
+				stats = self.stats[schema.name]
+				fluent = [atom for atom in schema.preconditions if atom[0] not in self.static]
+
+				if first_round:
+					# everything is new, so one join with every fact is enough
+					seeds = [None]
+				else:
+					# the join has to use one of the new facts, for one of the fluent preconditions
+					seeds = fluent
+
+				for seed in seeds:
+					order = self._order(schema, seed)
+					stores = [delta if seed is not None else self.reached] + [self.reached] * (len(order) - 1)
+					args = [None] * len(schema.parameters)
+
+					for partial in self._join(order, stores, candidates[schema.name], args):
+						for ground in self._complete(schema, candidates[schema.name], partial):
+							if ground in made[schema.name]:
+								continue
+							made[schema.name].add(ground)
+							stats.grounded += 1
+
+							action = GroundAction(schema, ground)
+							new_facts.extend(action.add)
+
+							stats.seconds += time.time() - schema_start
+							yield action
+							schema_start = time.time()
+
+				stats.seconds += time.time() - schema_start
+
+			# the facts of this round are only joined from the next one on
+			delta = FactStore()
+			for fact in new_facts:
+				if self.reached.add_ids(fact):
+					delta.add_ids(fact)
+			first_round = False
+			if len(delta) == 0:
+				break
+
+		self.seconds = time.time() - start
+
+	def catalogue(self):
+		'''Return the AtomCatalogue of the reached facts (ground first, to get all the reachable ones).'''
+
+		return AtomCatalogue(self.domain_tree, self.problem_tree, list(self.reached))
+
+	def report(self):
+		'''Return a short report of the last grounding: time, and the ground and pruned actions of each schema.'''
+
+		lines = ["grounded %d actions in %.3f s, %d reachable facts" % (
+			sum(stats.grounded for stats in self.stats.values()), self.seconds, len(self.reached))]
+		for schema in self.schemas:
+			stats = self.stats.get(schema.name)
+			if stats is not None:
+				lines.append("    %s: %d ground, %d pruned (of %d), %.3f s" % (
+					schema.name, stats.grounded, stats.pruned(), stats.naive, stats.seconds))
+		return "\n".join(lines)
@@ -4,8 +4,46 @@
 ################################
 
 import re
+import hashlib
 from utils import get_contents
-import time
+from query import Query
+
+class SymbolTable(object):
+	'''Interns names, so every distinct name is stored once, and has an integer id.
+	Names which went through the same table can be compared by identity (or by id).'''
+	
+	def __init__(self):
+		# name -> id, and id -> name
+		self.ids = {}
+		self.names = []
+		
+	def __len__(self):
+		return len(self.names)
+		
+	def id_of(self, name):
+		'''Return the id of the given name. Add the name if it is new.'''
+		
+		i = self.ids.get(name)
+		if i is None:
+			i = self.ids[name] = len(self.names)
+			self.names.append(name)
+		return i
+		
+	def intern(self, name):
+		'''Return the table's copy of the given name. Add the name if it is new.'''
+		
+		return self.names[self.id_of(name)]
+		
+	def lookup(self, name):
+		'''Return the table's copy of the given name, or None if the table has never seen it.'''
+		
+		i = self.ids.get(name)
+		if i is None:
+			return None
+		return self.names[i]
+		
+''' The symbol table shared by all trees parsed in this session. '''
+SYMBOLS = SymbolTable()
 
 class Node(object):
 	'''A node in the DOM-like LispTree.
@@ -16,57 +54,207 @@ class Node(object):
 	
 	ROOT_NAME = "root-elem"
 	
-	@staticmethod
-	def hash_node(fname):
-		'''Creates a unique hash for each node which could be used in a tree.
-		Allows for quick lookups.
-		The time is used as a salt to 'guarantee' uniqueness.
-		This hash is easily broken by a determined attacker, but will work if no one tries to break it on purpose.'''
-		
-		h = hash(fname + str(time.time()))
-		return h
+	# nodes with fewer children than this are scanned, not indexed, by seek
+	INDEX_MIN_CHILDREN = 8
+	
+	# no per-node __dict__, since big problem files have millions of nodes
+	__slots__ = ("_name", "parent", "children", "fn", "_index", "_lisp", "_frozen", "_fp")
 	
 	def __init__(self, fname, fn=False):
 		'''Create a new node.
 		fn states whether this is a function or not - used to differentiate between (sum) and sum.'''
 		
-		self.name = fname
+		self._name = SYMBOLS.intern(fname)
 		self.parent = None
-		self.children = []
+		# most nodes are leaves, so they share an empty tuple until they get a child
+		self.children = [] if fn else ()
 		self.fn = fn
-		self.hash = Node.hash_node(fname)
+		# child name -> positions of the children with that name, built on demand by _positions_of
+		self._index = None
+		# (indent, text) of the last cached rendering of this subtree, see to_lisp
+		self._lisp = None
+		# see freeze
+		self._frozen = False
+		# see fingerprint
+		self._fp = None
 		
-		# keep in memory whether this is the root
-		self.root = (fname == self.ROOT_NAME)
-			
+	@property
+	def name(self):
+		'''The name of this node. Always interned in SYMBOLS, so names can be compared with 'is'.'''
+		
+		return self._name
+		
+	@name.setter
+	def name(self, fname):
+		if self._frozen:
+			raise TypeError("Can't rename a frozen node")
+		
+		self._name = SYMBOLS.intern(fname)
+		
+		self._dirty()
+		if self.parent is not None:
+			self.parent._index = None
+			self.parent._dirty()
+		
+	@property
+	def hash(self):
+		'''A unique id for this node, which could be used in a tree.
+		Allows for quick lookups. Unique among the nodes which are alive, and free to create.'''
+		
+		return id(self)
 		
 	def is_root(self):
 		'''Return True iff the current node is the root of the tree.'''
 		
-		return self.root
+		return self.name == self.ROOT_NAME
 		
 	def add_child(self, node, index=None):
 		'''Add the given node (or subtree) as a child of the current tree (node).
 		If index is unspecified, put it at the *END* of the child list (i.e. append).
-		If index is specified, put it *after* the given index.'''
+		If index is specified, put it *after* the given index.
+		A frozen node is shared, not re-parented, so it can be added under any number of nodes.'''
+		
+		if self._frozen:
+			raise TypeError("Can't add children to a frozen node")
+		
+		if not node._frozen:
+			node.parent = self
+		self._dirty()
 		
-		node.parent = self
+		if not isinstance(self.children, list):
+			self.children = list(self.children)
 		
 		if index is None:
 			self.children.append(node)
+			
+			if self._index is not None:
+				self._index.setdefault(node._name, []).append(len(self.children) - 1)
 		else:
 			self.children.insert(index + 1, node)
 			
+			# the positions after the new child have all moved
+			self._index = None
+			
+	def freeze(self):
+		'''Make this subtree immutable, so that it can be shared: added under many nodes, without copying it.
+		Frozen nodes have no parent, since they can have many. Use walk or seek_trail to know where a node is.
+		Adding children to (or renaming) a frozen node raises TypeError. Return this node.'''
+		
+		stack = [self]
+		
+		while stack:
+			node = stack.pop()
+			if node._frozen:
+				continue
+			
+			node._frozen = True
+			node.parent = None
+			node.children = tuple(node.children)
+			stack.extend(node.children)
+		
+		return self
+		
+	def walk(self):
+		'''Return a generator over (node, parent) for every node of this subtree, in document order.
+		The parents come from the walk, so they are right in frozen (shared) subtrees as well. This node's is None.'''
+		
+		stack = [(self, None)]
+		
+		while stack:
+			node, parent = stack.pop()
+			yield node, parent
+			
+			children = node.children
+			for i in xrange(len(children) - 1, -1, -1):
+				stack.append((children[i], node))
+		
+	def _dirty(self):
+		'''Drop the cached rendering and fingerprint of this node and of its ancestors, since the node has changed.
+		Atoms and root nodes never have a cached rendering, so this goes on past them. Any other node is cached
+		whenever one of its ancestors is, so this can stop at the first one without a cache.'''
+		
+		node = self
+		while node is not None:
+			if node._lisp is None and node._fp is None and node.fn and not node.is_root():
+				break
+			node._lisp = None
+			node._fp = None
+			node = node.parent
+			
+	def fingerprint(self):
+		'''Return the structural fingerprint of this subtree: a sha1 digest (20-byte string) of the names and shape.
+		Identical subtrees have the same fingerprint, in any tree, backend or run, so it can be used as a content key.
+		Computed bottom-up without recursion, and cached: changes (add_child, merge_tree, renaming)
+		only make the changed node and its ancestors compute theirs again.'''
+		
+		if self._fp is not None:
+			return self._fp
+		
+		# pairs of (node, whether its children are done)
+		stack = [(self, False)]
+		# (name, fn) -> fingerprint of a childless node, since most nodes are leaves, with the same few names
+		leaves = {}
+		
+		while stack:
+			node, ready = stack.pop()
+			if node._fp is not None:
+				continue
+			
+			children = node.children
+			if ready or not children:
+				node._fp = subtree_digest(node._name, node.fn, [child._fp for child in children])
+				continue
+			
+			stack.append((node, True))
+			for child in children:
+				if child._fp is None:
+					if child.children:
+						stack.append((child, False))
+					else:
+						# leaves don't need to go on the stack
+						key = (child._name, child.fn)
+						digest = leaves.get(key)
+						if digest is None:
+							digest = leaves[key] = subtree_digest(child._name, child.fn, ())
+						child._fp = digest
+		
+		return self._fp
+		
+	def structurally_equal(self, other):
+		'''Return True iff the given subtree (of any backend) has the same names and shape as this one.
+		Takes O(1) once both fingerprints are known.'''
+		
+		return self.fingerprint() == other.fingerprint()
+			
+	def _positions_of(self, name):
+		'''Return the positions of the children with the given name, in order.
+		The name must be interned in SYMBOLS.'''
+		
+		children = self.children
+		
+		if len(children) < Node.INDEX_MIN_CHILDREN:
+			return [i for i, child in enumerate(children) if child._name is name]
+		
+		if self._index is None:
+			index = {}
+			for i, child in enumerate(children):
+				index.setdefault(child._name, []).append(i)
+			self._index = index
+		
+		return self._index.get(name, ())
+			
 	def index_of(self, subtree):
 		'''Return the index of the given subtree.
 		Return False if not found'''
 		
-		hashes = [c.hash for c in self.children]
-		if subtree.hash in hashes:
-			return hashes.index(subtree.hash)
-		else:
+		if not isinstance(subtree, Node):
 			return False
 		
+		for i in self._positions_of(subtree._name):
+			if self.children[i] is subtree:
+				return i
+		return False
+		
 	def merge_tree(self, tree):
 		'''Slightly different from add_child because this is a fully-formed tree.
 		Procedure is to remove the root node, then add everything'''
@@ -77,67 +265,59 @@ class Node(object):
 		else:
 			self.add_child(tree)
 			
+	def copy(self, node_class=None):
+		'''Return a deep copy of this subtree, which can be changed without touching the original.
+		The copies are made with node_class, which is the class of this node by default.
+		Frozen subtrees can't change, so they are shared by the copy instead of copied.'''
+		
+		node_class = node_class or type(self)
+		top = node_class(self.name, self.fn)
+		# pairs of (original node, its copy) whose children still need copying
+		stack = [(self, top)]
+		
+		while stack:
+			node, copy = stack.pop()
+			for child in node.children:
+				if child._frozen:
+					copy.add_child(child)
+					continue
+				
+				child_copy = node_class(child.name, child.fn)
+				copy.add_child(child_copy)
+				if child.children:
+					stack.append((child, child_copy))
+		
+		return top
+		
 	def seek_all_list(self, path):
 		'''Return *a list* of the subtrees found.'''
 		
 		if len(path) == 0:
-			#return [self]
-			#yield self
 			return
 		
-		stop = path[0]
-		results = []
+		return list(self.seek_all(path))
+		
+	def _seek_step(self, stop):
+		'''Return the positions of the children matched by one step of a path: either "<name>", or ("<name>", index).'''
 		
 		if isinstance(stop, tuple):
 			stop, i = stop
-			j = 0
-			for child in self.children:
-				if child.name == stop and  i == j:
-					results.extend(child.seek_all(path[1:]))
-					return results
-					#for item in child.seek_all(path[1:]):
-					#	yield item
-				elif child.name == stop:
-					j += 1
+			assert i >= 0
+			positions = self._positions_of(SYMBOLS.lookup(stop))
+			return positions[i : i + 1]
 		else:
-			for child in self.children:
-				if child.name == stop:
-					results.extend(child.seek_all(path[1:]))
-					#for item in child.seek_all(path[1:]):
-					#	yield item
-						
-		return results
+			return self._positions_of(SYMBOLS.lookup(stop))
 			
 	def seek_all(self, path):
 		'''Return *a generator* over the subtrees found.'''
 		
 		if len(path) == 0:
-			#return [self]
 			yield self
 			return
 		
-		stop = path[0]
-		#results = []
-		
-		if isinstance(stop, tuple):
-			stop, i = stop
-			j = 0
-			for child in self.children:
-				if child.name == stop and  i == j:
-					#results.extend(child.seek_all(path[1:]))
-					#return results
-					for item in child.seek_all(path[1:]):
-						yield item
-				elif child.name == stop:
-					j += 1
-		else:
-			for child in self.children:
-				if child.name == stop:
-					#results.extend(child.seek_all(path[1:]))
-					for item in child.seek_all(path[1:]):
-						yield item
-						
-		#return results
+		for i in self._seek_step(path[0]):
+			for item in self.children[i].seek_all(path[1:]):
+				yield item
 		
 	def seek(self, path):
 		'''Return subtree if found, False otherwise.
@@ -151,26 +331,26 @@ class Node(object):
 		if len(path) == 0:
 			return self
 		
-		stop = path[0]
-		if isinstance(stop, tuple):
-			stop, i = stop
-			assert i >= 0
-			j = 0
+		for i in self._seek_step(path[0]):
+			result = self.children[i].seek(path[1:])
+			if result:
+				return result
+		# if nothing found
+		return False
 			
-			for child in l:
-				if child.name == stop and  i == j:
-					return child.seek(path[1:])
-				elif child.name == stop:
-					j += 1
-			return False
-		else:
-			for child in self.children:
-				if child.name == stop:
-					result = child.seek(path[1:])
-					if result:
-						return result
-			# if nothing found
-			return False
+	def seek_trail(self, path):
+		'''Like seek, but return the list of nodes from this one down to the match (both included), False if not found.
+		Gives the parents of the match, even in frozen (shared) subtrees.'''
+		
+		if len(path) == 0:
+			return [self]
+		
+		for i in self._seek_step(path[0]):
+			trail = self.children[i].seek_trail(path[1:])
+			if trail:
+				return [self] + trail
+		# if nothing found
+		return False
 			
 	def print_tree(self, indent=0):
 		'''Print ASCII horizontal representation of the tree.
@@ -221,23 +401,43 @@ class Node(object):
 		#	seperate line (product 5 8) <-- indent + 1
 		# 	seperate line )
 		
-		spacing  = "\t" * indent
-		
-		if not isinstance(ntl, list):
-			return spacing + ntl # <-- the base case
+		return "".join(Node._iter_lisp_2(ntl, indent))
+	
+	@staticmethod
+	def _iter_lisp_2(ntl, indent=0):
+		'''Return a generator over chunks of to_lisp_2's output. Does not recurse.'''
 		
-		type_list = [isinstance(e, list) for e in ntl]
+		# work still to do, last item first: strings to write, or (nested token list, indent) pairs to convert
+		todo = [(ntl, indent)]
 		
-		if all(type_list):
-			return "\n".join([Node.to_lisp_2(e, indent) for e in ntl])
-		elif not any(type_list):
-			return "%s(%s)" % (spacing, " ".join(ntl[1:-1]))
-		else:
-			expr = spacing + "(\n"
-			for sublist in ntl[1:-1]:
-				expr += Node.to_lisp_2(sublist, indent + 1) + "\n"
-			expr += spacing + ")"
-			return expr
+		while todo:
+			item = todo.pop()
+			if isinstance(item, str):
+				yield item
+				continue
+			
+			ntl, indent = item
+			spacing = "\t" * indent
+			
+			if not isinstance(ntl, list):
+				yield spacing + ntl # <-- the base case
+				continue
+			
+			type_list = [isinstance(e, list) for e in ntl]
+			
+			if all(type_list):
+				for i in xrange(len(ntl) - 1, -1, -1):
+					todo.append((ntl[i], indent))
+					if i > 0:
+						todo.append("\n")
+			elif not any(type_list):
+				yield "%s(%s)" % (spacing, " ".join(ntl[1:-1]))
+			else:
+				yield spacing + "(\n"
+				todo.append(spacing + ")")
+				for sublist in reversed(ntl[1:-1]):
+					todo.append("\n")
+					todo.append((sublist, indent + 1))
 	
 	def _tokenize(self):
 		'''Tokenize the node and subtree.
@@ -260,41 +460,230 @@ class Node(object):
 			
 		return l
 			
-	def to_lisp(self, indent=0):
+	def to_lisp(self, indent=0, cache=False):
 		'''Convert this tree to lisp expressions.
-		Added some hacks for literals (' character), so code is a bit messy'''
+		Added some hacks for literals (' character), so code is a bit messy (see iter_lisp)
+		If cache is set, every function node keeps its text, and later calls only re-render the subtrees
+		which changed since (through add_child, merge_tree or the name setter). Costs memory for the texts.'''
 		
-		if self.is_root():
-			return "\n".join([child.to_lisp() for child in self.children])
-		elif not self.fn:
-			return self.name
+		return "".join(iter_lisp(self, indent, cache))
+		
+	def write_lisp(self, fp, indent=0, cache=False):
+		'''Write this tree as lisp expressions to the given file object, a bit at a time.
+		Writes exactly what to_lisp returns, without holding all of it in memory (unless cache is set, see to_lisp).'''
+		
+		write_lisp(self, fp, indent, cache)
+
+def iter_lisp(node, indent=0, cache=False):
+	'''Return a generator over chunks of the lisp expressions for the given tree (of any node backend).
+	The chunks add up to Node.to_lisp's output. Does not recurse, so it works for any depth,
+	and takes linear time, since no text is copied into its parent's text.
+	If cache is set, use and update the cached texts of the nodes (Node only, see Node.to_lisp).'''
+	
+	if node.is_root():
+		for i, child in enumerate(node.children):
+			if i > 0:
+				yield "\n"
+			for chunk in iter_lisp(child, 0, cache):
+				yield chunk
+		return
+	
+	if cache:
+		yield _cached_lisp(node, indent)
+		return
+	
+	text, frame = _open_lisp(node, indent)
+	yield text
+	if frame is None:
+		return
+	
+	# the multi-line expressions being written: [iterator over the children, indent, whether the last child was a quote]
+	stack = [frame]
+	
+	while stack:
+		frame = stack[-1]
+		child = next(frame[0], None)
+		
+		if child is None:
+			stack.pop()
+			yield "\t" * frame[1] + ")"
+			if stack:
+				# the expression was a child of the one below it
+				yield "\n"
+				stack[-1][2] = False
+			continue
+		
+		# a literal (') is stuck to the next expression, without spacing
+		if not frame[2]:
+			yield "\t" * (frame[1] + 1)
+		
+		text, child_frame = _open_lisp(child, frame[1] + 1)
+		yield text
+		
+		if child_frame is not None:
+			stack.append(child_frame)
 		else:
-			if len(self.children) == 0:
-				return "(%s)" % ("" if self.name == Node.EVAL_NAME else self.name)
+			frame[2] = (text == "'")
+			if not frame[2]:
+				yield "\n"
+
+def _open_lisp(node, indent, cache=False):
+	'''Start writing the given node, as a child at the given indent.
+	Return the text, and a frame for iter_lisp if the node is a multi-line expression (None otherwise).
+	If cache is set, return the node's cached text if it has one, and cache the text of one-liners.'''
+	
+	if node.is_root():
+		return "".join(iter_lisp(node, 0, cache)), None
+	elif not node.fn:
+		return node.name, None
+	
+	if cache and node._lisp is not None and node._lisp[0] == indent:
+		return node._lisp[1], None
+	
+	children = node.children
+	name = node.name
+	
+	if len(children) == 0:
+		text = "(%s)" % ("" if name == Node.EVAL_NAME else name)
+	
+	# check if it's a one-liner
+	elif all([not child.fn for child in children]):
+		text = "(%s %s)" % (name, " ".join([_open_lisp(child, 0)[0] for child in children]))
+	else:
+		# don't need to indent, will be indented by parent
+		return "(" + ("" if name == Node.EVAL_NAME else name) + "\n", [iter(children), indent, False]
+	
+	if cache:
+		node._lisp = (indent, text)
+	return text, None
+
+def _cached_lisp(node, indent):
+	'''Return the lisp expressions for the given Node, like iter_lisp,
+	but splice in the cached text of unchanged subtrees, and cache the text of everything else.'''
+	
+	text, frame = _open_lisp(node, indent, True)
+	if frame is None:
+		return text
+	
+	# like the frames of iter_lisp, with the node and the pieces of its text so far
+	stack = [frame + [node, [text]]]
+	
+	while True:
+		frame = stack[-1]
+		child = next(frame[0], None)
+		
+		if child is None:
+			stack.pop()
+			frame[4].append("\t" * frame[1] + ")")
+			text = "".join(frame[4])
+			frame[3]._lisp = (frame[1], text)
 			
-			# check if it's a one-liner
-			elif all([not child.fn for child in self.children]):
-				return "(%s %s)" % (self.name, " ".join([child.to_lisp() for child in self.children]))
-			else:
-				# don't need to indent, will be indented by parent
-				expr = "("
-				expr += "" if self.name == Node.EVAL_NAME else self.name
-				expr += "\n"
-				
-				prev_expr = ""
-				
-				for child in self.children:
-					child_expr = child.to_lisp(indent + 1)
-					spacing = "" if prev_expr == "'" else "\t" * (indent + 1)
-					expr += spacing + child_expr + ("" if child_expr == "'" else "\n")
-					prev_expr = child_expr
-				expr += "\t" * (indent) + ")"
-				return expr
+			if not stack:
+				return text
+			
+			stack[-1][4].append(text)
+			stack[-1][4].append("\n")
+			stack[-1][2] = False
+			continue
+		
+		# a literal (') is stuck to the next expression, without spacing
+		if not frame[2]:
+			frame[4].append("\t" * (frame[1] + 1))
+		
+		text, child_frame = _open_lisp(child, frame[1] + 1, True)
+		
+		if child_frame is not None:
+			stack.append(child_frame + [child, [text]])
+		else:
+			frame[4].append(text)
+			frame[2] = (text == "'")
+			if not frame[2]:
+				frame[4].append("\n")
+
+def write_lisp(node, fp, indent=0, cache=False):
+	'''Write the lisp expressions for the given tree (of any node backend) to the given file object, a bit at a time.'''
+	
+	chunks = []
+	for chunk in iter_lisp(node, indent, cache):
+		chunks.append(chunk)
+		if len(chunks) >= 4096:
+			fp.write("".join(chunks))
+			chunks = []
+	fp.write("".join(chunks))
+
+def subtree_digest(name, fn, child_digests):
+	'''Return the fingerprint of a node with the given name and fn, whose children have the given fingerprints.
+	See Node.fingerprint.'''
+	
+	# the length keeps the name apart from the children
+	return hashlib.sha1("%s%d:%s%s" % ("(" if fn else "'", len(name), name, "".join(child_digests))).digest()
+
+class HashConsTable(object):
+	'''Canonical copies of subtrees, for hash-consing: every distinct subtree is stored once, and shared
+	(frozen, see Node.freeze) by all the places it occurs. See LispParser.get_tree.
+	Subtrees are keyed on their structure: class, name, fn, and the (canonical) children.'''
+	
+	def __init__(self):
+		# structural key -> canonical node
+		self.nodes = {}
+		# how many nodes went through intern, shared or not
+		self.seen = 0
+		
+	def __len__(self):
+		return len(self.nodes)
+		
+	def intern(self, node):
+		'''Return the table's copy of the given node, whose children must be canonical already.
+		If the node is new, freeze it and make it the canonical one.'''
+		
+		self.seen += 1
+		
+		# the children are canonical, so the same structure has the same children, by identity (nodes hash by id)
+		children = tuple(node.children)
+		key = (type(node), node.name, node.fn, children)
+		
+		canonical = self.nodes.get(key)
+		if canonical is None:
+			# the key and the frozen node share the tuple of children
+			node.children = children
+			canonical = self.nodes[key] = node.freeze()
+		return canonical
+		
+	def ratio(self):
+		'''Return how many nodes there are for every distinct one (1.0 means no duplicates).'''
+		
+		return float(self.seen) / len(self.nodes) if self.nodes else 1.0
+		
+	def report(self):
+		'''Return a one-line summary of the deduplication.'''
+		
+		saved = 100.0 * (self.seen - len(self.nodes)) / self.seen if self.seen else 0.0
+		return "%d nodes, %d distinct: %.2fx deduplication (%.1f%% of the nodes shared)" % (self.seen, len(self.nodes), self.ratio(), saved)
 
 class LispParser(object):
 	'''Parser for the lisp language.
 	Allows extracting tokens, and creating a dom-like tree.
 	Also allows cleaning out junk and comments.'''
+	
+	# One scan does comment stripping, paren splitting and tokenizing.
+	# Comments (and the newline ending them) are dropped without acting as separators,
+	# so an atom broken by a comment is glued back together, as _remove_comments always did.
+	_TOKEN_RE = re.compile(r"([()]|[^\s();]+(?:(?:;[^\n]*\n)+[^\s();]+)*)|;[^\n]*")
+	_GLUED_COMMENT_RE = re.compile(r";[^\n]*\n")
+	
+	# the class of the nodes made by get_tree
+	NODE_CLASS = Node
+	
+	# bump when the tokenizer or the tree building change the trees made from some text, see parse_cache
+	PARSER_VERSION = 1
+	
+	# the kinds of parse events
+	OPEN = "open"
+	ATOM = "atom"
+	CLOSE = "close"
+	
+	# how much of a file iter_tokens reads at a time
+	CHUNK_SIZE = 1 << 16
 		
 	@staticmethod
 	def _remove_comments(expr):
@@ -307,52 +696,246 @@ class LispParser(object):
 
 	@staticmethod
 	def get_tokens(expr):
-		'''Return a list of lisp tokens. Tokens are literals, as well as brackets, and functions/operators.'''
-
-		return LispParser._remove_comments(expr).replace("(", " ( ").replace(")", " ) ").split()
+		'''Return a list of lisp tokens. Tokens are literals, as well as brackets, and functions/operators.
+		Comments are stripped in the same pass.'''
+		
+		tokens = LispParser._TOKEN_RE.findall(expr)
+		
+		if ";" in expr:
+			# drop the comments, and cut them out of atoms which were glued across one
+			return [(LispParser._GLUED_COMMENT_RE.sub("", t) if ";" in t else t) for t in tokens if t]
+		else:
+			return tokens
 	
 	@staticmethod
-	def get_tree(expr):
-		'''Return a DOM-like tree structure.'''
+	def iter_tokens(fp, chunk_size=None):
+		'''Return a generator over the lisp tokens in the given file object, which is read in chunks.
+		Gives the same tokens as get_tokens(fp.read()), but only holds about a chunk in memory.'''
 		
-		tokens = LispParser.get_tokens(expr)
-		root = Node(Node.ROOT_NAME, False)
+		carry = ""
 		
-		while len(tokens) > 0:
-			subtree = LispParser._make_lisp_tree_helper(tokens)
-			if subtree is not None:
-				root.add_child(subtree)
+		while True:
+			chunk = fp.read(chunk_size or LispParser.CHUNK_SIZE)
+			if not chunk:
+				break
+			
+			# only tokenize up to a paren, which is never part of a token or a comment
+			buf = carry + chunk
+			cut = LispParser._safe_cut(buf)
+			for token in LispParser.get_tokens(buf[:cut]):
+				yield token
+			carry = buf[cut:]
+			
+		for token in LispParser.get_tokens(carry):
+			yield token
+			
+	@staticmethod
+	def _safe_cut(buf):
+		'''Return the position just past the last paren in buf which is not in a comment, or 0 if there is none.'''
+		
+		p = max(buf.rfind("("), buf.rfind(")"))
+		
+		while p >= 0:
+			line_start = buf.rfind("\n", 0, p) + 1
+			comment = buf.find(";", line_start, p)
+			if comment < 0:
+				return p + 1
+			# the paren is in a comment, so try the ones before the comment
+			p = max(buf.rfind("(", 0, comment), buf.rfind(")", 0, comment))
+			
+		return 0
 		
-		return root
-	
 	@staticmethod
-	def _make_lisp_tree_helper(tokens):	
-		'''Helper to the make_lisp_tree function. This does most of the work.
-		tokens - list of lisp tokens to make the tree out of.'''
-		
-		token = tokens.pop(0)
-		if token == "(":
-			# consider an empty expression an empty eval exression
-			if tokens[0] == ")":
-				tokens.pop(0)
-				return Node(Node.EVAL_NAME, True)
-				#return None # a null-child
-			
-			if tokens[0] == "(":
-				# a function call on the stuff inside the next expression
-				root = Node(Node.EVAL_NAME, True)
+	def _events(tokens):
+		'''Return a generator over the parse events of the given tokens (any iterable).
+		Events are pairs: (OPEN, name), (ATOM, name) or (CLOSE, None).
+		An open event names the expression, which is Node.EVAL_NAME for things like ((lambda : 2 * 2)) and ().'''
+		
+		OPEN, ATOM, CLOSE = LispParser.OPEN, LispParser.ATOM, LispParser.CLOSE
+		
+		depth = 0
+		# True if the last token opened an expression which has no name yet
+		opened = False
+		
+		for token in tokens:
+			if opened:
+				if token == "(":
+					# a function call on the stuff inside the next expression
+					yield OPEN, Node.EVAL_NAME
+					depth += 1
+					continue
+				
+				opened = False
+				if token == ")":
+					# consider an empty expression an empty eval exression
+					yield OPEN, Node.EVAL_NAME
+					yield CLOSE, None
+					depth -= 1
+				else:
+					yield OPEN, token
+			elif token == "(":
+				opened = True
+				depth += 1
+			elif token == ")":
+				if depth == 0:
+					raise SyntaxError("Unexpected closing paren")
+				depth -= 1
+				yield CLOSE, None
 			else:
-				root = Node(tokens.pop(0), True)
+				yield ATOM, token
+				
+		if depth > 0:
+			raise SyntaxError("Missing closing paren")
+			
+	@staticmethod
+	def iter_events(fp, chunk_size=None):
+		'''Return a generator over the parse events (see _events) of the given file object, which is read in chunks.
+		Memory is bounded by the chunk size, no matter how big the file is.'''
+		
+		return LispParser._events(LispParser.iter_tokens(fp, chunk_size))
+	
+	@staticmethod
+	def get_tree(expr, flat=False, hashcons=None, cache=None):
+		'''Return a DOM-like tree structure.
+		If flat is set, the tree is stored in a flat_tree.FlatTree (for very large files),
+		and a FlatNode view of its root is returned.
+		If hashcons is a HashConsTable, identical subtrees are only stored once, in the table, and shared.
+		Shared subtrees are frozen, so everything below the root is read-only.
+		If cache is a parse_cache.ParseCache, the tree is loaded from it when the same text was parsed before
+		(only for plain trees: not with flat or hashcons).'''
+		
+		if cache is not None and not flat and hashcons is None:
+			return cache.get_tree(expr, LispParser)
+		
+		return LispParser.build_tree(LispParser._events(LispParser.get_tokens(expr)), flat, hashcons)
+		
+	@staticmethod
+	def get_tree_mapped(fname):
+		'''Return a DOM-like tree structure for the given file, which is memory-mapped instead of read.
+		The tokens are spans of the mapped file, and only become strings when a node's name is read.
+		The tree is a flat one (see get_tree), and the file stays mapped as long as the tree is alive.'''
+		
+		from flat_tree import MappedTree
+		tree = MappedTree(fname)
+		return LispParser.build_tree(LispParser._events(tree.iter_tokens()), tree)
+		
+	@staticmethod
+	def build_tree(events, flat=False, hashcons=None):
+		'''Return a DOM-like tree structure, built from parse events (like the ones from iter_events).
+		See get_tree for flat and hashcons. flat can also be an (empty) flat_tree.FlatTree to build into.'''
 		
-			while tokens[0] != ")":
-				subtree = LispParser._make_lisp_tree_helper(tokens)
-				if subtree is not None:
-					root.add_child(subtree)
+		if flat and hashcons is not None:
+			raise ValueError("Hash-consing only makes Node trees")
 		
-			tokens.pop(0) # remove closing paren
-			return root
-		elif token == ")":
-			raise SyntaxError("Unexpected closing paren")
+		if flat:
+			from flat_tree import FlatTree
+			tree = flat if isinstance(flat, FlatTree) else FlatTree()
+			root, node_class = tree.root(), tree.make_node
 		else:
-			return Node(token, False)
-		
\ No newline at end of file
+			root, node_class = Node(Node.ROOT_NAME, False), Node
+		
+		for subtree in LispParser._build(events, node_class, hashcons):
+			root.add_child(subtree)
+		
+		return root
+	
+	@staticmethod
+	def _build(events, node_class=Node, hashcons=None):
+		'''Helper to the make_lisp_tree function. This does most of the work.
+		events - parse events to make the tree out of.
+		node_class - the class of the nodes to make (Node or a subclass, like PDDLNode),
+			or any factory with the same signature, like flat_tree.FlatTree.make_node.
+		hashcons - a HashConsTable to swap every completed node for its canonical copy, or None.
+		Return a generator over the top-level subtrees, as each one is completed.
+		
+		Does not recurse: the open expressions are kept on an explicit stack,
+		so there is no limit on how deeply the expressions can be nested.'''
+		
+		OPEN, ATOM = LispParser.OPEN, LispParser.ATOM
+		
+		# expressions which have been opened, but not yet closed
+		stack = []
+		
+		for kind, name in events:
+			if kind == ATOM:
+				node = node_class(name, False)
+			elif kind == OPEN:
+				stack.append(node_class(name, True))
+				continue
+			elif stack:
+				node = stack.pop()
+			else:
+				raise SyntaxError("Unexpected closing paren")
+			
+			if hashcons is not None:
+				node = hashcons.intern(node)
+			
+			# node is complete, so hang it on the innermost open expression
+			if stack:
+				stack[-1].add_child(node)
+			else:
+				yield node
+				
+		if stack:
+			raise SyntaxError("Missing closing paren")
+			
+	@staticmethod
+	def select_subtrees(events, paths, node_class=Node):
+		'''Build only the subtrees at the given paths, from a stream of parse events.
+		Return a generator over (path number, subtree) pairs, as each subtree is completed
+		(so a match nested in another match comes first).
+		Paths start at the top-level expressions, like the ones for the root of get_tree, and can use the query.Query steps.
+		Everything which is not on a path is skipped without making any nodes,
+		and a path like [":init", "*"] streams the facts one by one instead of building the whole :init.'''
+		
+		OPEN, ATOM, CLOSE = LispParser.OPEN, LispParser.ATOM, LispParser.CLOSE
+		query = Query.compile(paths)
+		
+		# the open expressions: [automaton state, sibling name counts, position of the next child, node or None]
+		stack = [[query.start, {}, 0, None]]
+		# how deep we are in an expression which is being skipped
+		skip = 0
+		
+		for kind, name in events:
+			if skip:
+				if kind == OPEN:
+					skip += 1
+				elif kind == CLOSE:
+					skip -= 1
+				continue
+			
+			if kind == CLOSE:
+				state, _, _, node = stack.pop()
+				if node is not None:
+					if stack[-1][3] is not None:
+						stack[-1][3].add_child(node)
+					for q in state.matches:
+						yield q, node
+				continue
+			
+			frame = stack[-1]
+			parent_state, counts, j, parent = frame
+			frame[2] = j + 1
+			
+			if parent_state.needs_counts:
+				k = counts.get(name, 0)
+				counts[name] = k + 1
+			else:
+				k = None
+			
+			state = query.step(parent_state, name, k, j)
+			building = parent is not None or len(state.matches) > 0
+			
+			if kind == ATOM:
+				if building:
+					node = node_class(name, False)
+					if parent is not None:
+						parent.add_child(node)
+					for q in state.matches:
+						yield q, node
+			elif building:
+				stack.append([state, {}, 0, node_class(name, True)])
+			elif state.dead or state.terminal:
+				skip = 1
+			else:
+				stack.append([state, {}, 0, None])
@@ -0,0 +1,286 @@
+''' A persistent, on-disk cache of parsed trees, keyed by the hash of the parsed text '''
+
+from lisp_utils import SYMBOLS
+from array import array
+from itertools import chain, repeat
+from operator import add
+import gc
+import hashlib
+import marshal
+import os
+import tempfile
+import time
+
+class ParseCache(object):
+	'''A directory of parsed trees, so that files which don't change are only parsed once.
+	Entries are keyed by the sha1 of the text, the parser (LispParser, PDDLParser), its PARSER_VERSION and VERSION,
+	and hold a compact breadth-first encoding of the tree, which loads several times faster than parsing.
+	Once the directory is over max_bytes, the least recently used entries are removed.
+	Temporary files left by a process which died while storing an entry are removed after STALE_SECONDS.
+	Corrupt (or unreadable) entries are removed, and the text is parsed again.
+	Only makes Node trees (of the parser's NODE_CLASS): not flat or hash-consed ones.'''
+
+	''' Bump when the encoding changes, so old entries are not used. (Parser changes bump the parser's PARSER_VERSION.) '''
+	VERSION = 2
+
+	# the suffix of entry files, and of the temporary files they are written to
+	SUFFIX = ".tree"
+	TMP_SUFFIX = ".tree-tmp"
+
+	# how old a temporary file has to be for evict to remove it: its writer must be gone
+	STALE_SECONDS = 3600
+
+	# the environment variable with the directory for from_environment
+	ENVIRONMENT_VARIABLE = "LISP_PARSE_CACHE"
+
+	def __init__(self, directory, max_bytes=256 << 20):
+		'''Use (and create, if needed) the given directory for the cache, which holds at most about max_bytes.'''
+
+		self.directory = directory
+		self.max_bytes = max_bytes
+
+		if not os.path.isdir(directory):
+			os.makedirs(directory)
+
+		# how many trees were loaded, parsed, and found corrupt
+		self.hits = self.misses = self.corrupt = 0
+
+		# the size of the directory at the last evict, plus the entries stored since; None before the first evict.
+		# Entries stored by other processes are only counted by the next evict.
+		self._size = None
+
+	@staticmethod
+	def from_environment():
+		'''Return a cache for the directory named by ENVIRONMENT_VARIABLE, or None if it's not set.'''
+
+		directory = os.environ.get(ParseCache.ENVIRONMENT_VARIABLE)
+		return ParseCache(directory) if directory else None
+
+	def _path(self, expr, parser):
+		'''Return the path of the entry for the given text and parser.'''
+
+		key = "%s-%s-%d-%d" % (hashlib.sha1(expr).hexdigest(), parser.__name__, parser.PARSER_VERSION, ParseCache.VERSION)
+		return os.path.join(self.directory, key + ParseCache.SUFFIX)
+
+	def get_tree(self, expr, parser):
+		'''Return the tree of the given text, as parser.get_tree(expr) would. Load it from the cache if it's there.'''
+
+		path = self._path(expr, parser)
+
+		if os.path.exists(path):
+			try:
+				tree = ParseCache.load(path, parser.NODE_CLASS)
+			except Exception:
+				# anything can go wrong with a damaged file: parse the text again instead
+				self.corrupt += 1
+				self._remove(path)
+			else:
+				self.hits += 1
+				# the modification time is the last use, for the eviction
+				try:
+					os.utime(path, None)
+				except OSError:
+					# evicted by another process since it was loaded
+					pass
+				return tree
+
+		self.misses += 1
+		tree = parser.get_tree(expr)
+		self._store(path, tree)
+		return tree
+
+	def get_tree_file(self, fname, parser):
+		'''Return the tree of the given file, see get_tree.'''
+
+		fp = open(fname)
+		expr = fp.read()
+		fp.close()
+		return self.get_tree(expr, parser)
+
+	@staticmethod
+	def encode(tree):
+		'''Return the given tree, encoded as a string.
+		It's a marshalled (VERSION, names, codes, fns, lists, starts, counts), where names are the distinct names,
+		and the nodes are numbered in breadth-first order, so the children of every node are consecutive:
+			codes, fns - for every node, the index of its name, and whether it's a function (one byte)
+			lists, starts, counts - for every node with a list of children (functions, and nodes with children),
+			its number, and the number of its first child and how many children it has'''
+
+		names = []
+		# name -> index in names
+		indexes = {}
+		codes = array("i")
+		fns = bytearray()
+		lists = array("i")
+		starts = array("i")
+		counts = array("i")
+
+		queue = [tree]
+		i = 0
+		while i < len(queue):
+			node = queue[i]
+			name = node.name
+
+			j = indexes.get(name)
+			if j is None:
+				j = indexes[name] = len(names)
+				names.append(name)
+
+			children = node.children
+			codes.append(j)
+			fns.append(1 if node.fn else 0)
+			if isinstance(children, list):
+				lists.append(i)
+				starts.append(len(queue))
+				counts.append(len(children))
+				queue.extend(children)
+			i += 1
+
+		return marshal.dumps((ParseCache.VERSION, names, codes.tostring(), str(fns),
+			lists.tostring(), starts.tostring(), counts.tostring()))
+
+	@staticmethod
+	def _slots(node_class):
+		'''Return the names of the slots of node_class (which must only have slots, like Node).'''
+
+		slots = []
+		for cls in node_class.__mro__[:-1]:
+			if "__slots__" not in cls.__dict__:
+				raise TypeError("%s has no __slots__" % cls.__name__)
+			cls_slots = cls.__dict__["__slots__"]
+			slots.extend([cls_slots] if isinstance(cls_slots, str) else cls_slots)
+		return slots
+
+	@staticmethod
+	def decode(data, node_class):
+		'''Return the tree encoded in the given string (see encode), made of node_class nodes.
+		node_class has to use __slots__, like Node: the nodes are made and filled in with map over the slot
+		descriptors, without running any Python code for each node. The slots other than the name, parent,
+		children and fn get the values that a new node has.
+		Raise ValueError if the data is not a valid encoding.'''
+
+		version, names, code_string, fns, list_string, start_string, count_string = marshal.loads(data)
+		if version != ParseCache.VERSION:
+			raise ValueError("Cache entry has version %s" % version)
+
+		codes, lists, starts, counts = array("i"), array("i"), array("i"), array("i")
+		codes.fromstring(code_string)
+		lists.fromstring(list_string)
+		starts.fromstring(start_string)
+		counts.fromstring(count_string)
+
+		n = len(codes)
+		if n == 0 or len(fns) != n or not len(lists) == len(starts) == len(counts) or sum(counts) != n - 1:
+			raise ValueError("Cache entry has inconsistent sizes")
+
+		# intern every name once, instead of once per node
+		names = [SYMBOLS.intern(name) for name in names]
+		fns = map(bool, bytearray(fns))
+
+		# the tree has no garbage to collect, so don't let the collector walk it again and again while it grows
+		gc_enabled = gc.isenabled()
+		gc.disable()
+		try:
+			# the root is made the normal way, and the others get its values for the other slots
+			root = node_class(names[codes[0]], fns[0])
+			nodes = [root]
+			nodes.extend(map(node_class.__new__, repeat(node_class, n - 1)))
+
+			for slot in ParseCache._slots(node_class):
+				setter = getattr(node_class, slot).__set__
+				if slot == "_name":
+					map(setter, nodes, map(names.__getitem__, codes))
+				elif slot == "fn":
+					map(setter, nodes, fns)
+				elif slot == "parent" or slot == "children":
+					map(setter, nodes, repeat(None if slot == "parent" else (), n))
+				elif hasattr(root, slot):
+					map(setter, nodes, repeat(getattr(root, slot), n))
+
+			parents = map(nodes.__getitem__, lists)
+			children = map(nodes.__getslice__, starts, map(add, starts, counts))
+			map(node_class.children.__set__, parents, children)
+			# the children of the parents, in order, are nodes[1:]
+			map(node_class.parent.__set__, nodes[1:], chain.from_iterable(map(repeat, parents, counts)))
+		finally:
+			if gc_enabled:
+				gc.enable()
+
+		return root
+
+	@staticmethod
+	def load(path, node_class):
+		'''Return the tree in the given entry file. Raise ValueError if the file is corrupt.'''
+
+		fp = open(path, "rb")
+		data = fp.read()
+		fp.close()
+
+		# the file starts with the sha1 of the rest
+		digest, data = data[:20], data[20:]
+		if hashlib.sha1(data).digest() != digest:
+			raise ValueError("Cache entry %s is corrupt" % path)
+		return ParseCache.decode(data, node_class)
+
+	def _store(self, path, tree):
+		'''Write the entry for the given tree, then make room in the cache if needed.
+		The directory is only listed (by evict) for the first entry, and when the entries seem to go over max_bytes.'''
+
+		data = ParseCache.encode(tree)
+
+		# write to a temporary file, and move it into place, so that readers never see half an entry
+		fd, tmp_path = tempfile.mkstemp(suffix=ParseCache.TMP_SUFFIX, dir=self.directory)
+		try:
+			fp = os.fdopen(fd, "wb")
+			fp.write(hashlib.sha1(data).digest())
+			fp.write(data)
+			fp.close()
+			os.rename(tmp_path, path)
+		except Exception:
+			self._remove(tmp_path)
+			raise
+
+		if self._size is not None:
+			self._size += 20 + len(data)
+		if self._size is None or self._size > self.max_bytes:
+			self.evict()
+
+	def evict(self):
+		'''Remove the least recently used entries, until the cache holds at most max_bytes.
+		Also remove the temporary files which are older than STALE_SECONDS.'''
+
+		entries = []
+		total = 0
+		stale = time.time() - ParseCache.STALE_SECONDS
+		for fname in os.listdir(self.directory):
+			is_tmp = fname.endswith(ParseCache.TMP_SUFFIX)
+			if not (is_tmp or fname.endswith(ParseCache.SUFFIX)):
+				continue
+			path = os.path.join(self.directory, fname)
+			try:
+				stat = os.stat(path)
+			except OSError:
+				# removed by another process
+				continue
+			if is_tmp:
+				if stat.st_mtime < stale:
+					self._remove(path)
+				continue
+			entries.append((stat.st_mtime, stat.st_size, path))
+			total += stat.st_size
+
+		entries.sort()
+		for mtime, size, path in entries:
+			if total <= self.max_bytes:
+				break
+			self._remove(path)
+			total -= size
+		self._size = total
+
+	def _remove(self, path):
+		'''Remove the given file, if it's still there.'''
+
+		try:
+			os.remove(path)
+		except OSError:
+			pass
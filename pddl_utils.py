@@ -1,7 +1,29 @@
+import re
 from lisp_utils import Node, LispParser
+from flat_tree import FlatTree, FlatNode, MappedTree
+from query import Query
+from fact_store import FactStore
 
-class PDDLNode(Node):
-    '''A Node in a PDDL tree, which is has a Lisp-y syntax.'''
+def _lazy_field(key):
+    '''Return a property for a lazily-evaluated PDDL node field.
+    The values live in a dict which is only made for nodes where a field is set,
+    so leaf nodes don't pay for them.'''
+    
+    def get(self):
+        if self._lazy is None:
+            return None
+        return self._lazy.get(key)
+    
+    def set(self, value):
+        if self._lazy is None:
+            self._lazy = {}
+        self._lazy[key] = value
+    
+    return property(get, set)
+
+class PDDLAccessors(object):
+    '''The PDDL accessors, for any node backend which has the Node API.
+    The class using this needs a _lazy slot, set to None.'''
     
     ''' There are two types of PDDL files.'''
     PROBLEM = False
@@ -9,20 +31,19 @@ class PDDLNode(Node):
     
     ACTION_NAME = ":action"
     
-    def __init__(self, fname, fn=False):
-        '''Create a new node.
-        fn states whether this is a function or not - used to differentiate between (sum) and sum.'''
-        
-        # call to super
-        Node.__init__(self, fname, fn)
-        
-        # lazy evaluation
-        self.problem = None
-        self.domain = None
-        self.init_state = None
-        self.goal = None
-        self._type = None
-        
+    # the paths to the parts found by finalize
+    CRITICAL_PATHS = [["problem"], ["domain"], [":domain"], [":init"], [":goal"]]
+    
+    __slots__ = ()
+    
+    # lazy evaluation
+    problem = _lazy_field("problem")
+    domain = _lazy_field("domain")
+    init_state = _lazy_field("init_state")
+    goal = _lazy_field("goal")
+    facts = _lazy_field("facts")
+    _type = _lazy_field("type")
+    
     def __str__(self):
         '''String representation of PDDL Node.'''
         
@@ -88,7 +109,7 @@ class PDDLNode(Node):
         if self._type is None:
             self._classify()
             
-        if self._type == PDDLNode.PROBLEM:
+        if self._type == PDDLAccessors.PROBLEM:
             return False
         
         return self.seek([":predicates"])
@@ -99,7 +120,7 @@ class PDDLNode(Node):
         if self._type is None:
             self._classify()
             
-        if self._type == PDDLNode.PROBLEM:
+        if self._type == PDDLAccessors.PROBLEM:
             return False
         
         return self.seek_all([self.ACTION_NAME])
@@ -117,17 +138,28 @@ class PDDLNode(Node):
         Only classify if unclassified.'''
         
         if self._type is None:
-            self._type = (PDDLNode.PROBLEM if self.seek(["problem"]) else PDDLNode.DOMAIN)
+            self._type = (PDDLAccessors.PROBLEM if self.seek(["problem"]) else PDDLAccessors.DOMAIN)
         
     def finalize(self):
-        '''Once the tree is built, find all critical parts.'''
+        '''Once the tree is built, find all critical parts.
+        They are all found in one walk of the tree.'''
         
-        self._classify()
+        problem, domain, domain_ref, init_state, goal = Query.compile(PDDLAccessors.CRITICAL_PATHS).first(self)
         
-        self.get_problem()
-        self.get_domain()
-        self.get_init_state()
-        self.get_goal()
+        if self._type is None:
+            self._type = (PDDLAccessors.PROBLEM if problem else PDDLAccessors.DOMAIN)
+        
+        if self.problem is None and self._type == PDDLAccessors.PROBLEM:
+            self.problem = problem.children[0].name
+        
+        if self.domain is None:
+            self.domain = (domain if self._type == PDDLAccessors.DOMAIN else domain_ref).children[0].name
+        
+        if self.init_state is None:
+            self.init_state = init_state
+        
+        if self.goal is None:
+            self.goal = goal
         
     def get_problem(self):
         ''''Return the name of the problem. Return False if no problem subtree found.
@@ -135,7 +167,7 @@ class PDDLNode(Node):
         #Raise SyntaxError if the tree is from a Domain file
         
         
-        if self._type is not None and self._type == PDDLNode.DOMAIN:
+        if self._type is not None and self._type == PDDLAccessors.DOMAIN:
             return False
         #    raise SyntaxError("Domain file's PDDL tree has no associated problem")
         
@@ -151,7 +183,7 @@ class PDDLNode(Node):
             self._classify()
         
         if self.domain is None:
-            if self._type == PDDLNode.DOMAIN:
+            if self._type == PDDLAccessors.DOMAIN:
                 self.domain = self.seek(["domain"]).children[0].name
             else:
                 self.domain = self.seek([":domain"]).children[0].name
@@ -164,7 +196,7 @@ class PDDLNode(Node):
         if self._type is None:
             self._classify()
             
-        if self._type == PDDLNode.DOMAIN:
+        if self._type == PDDLAccessors.DOMAIN:
             return False
         
         return [child.name for child in self.seek([":objects"]).children]
@@ -177,6 +209,21 @@ class PDDLNode(Node):
             
         return self.init_state
     
+    def get_facts(self):
+        '''Return the initial state as an indexed fact_store.FactStore. Return False if this is a domain tree.
+        The store is built the first time, from the initial state subtree, so it doesn't see later changes to the tree.'''
+        
+        if self._type is None:
+            self._classify()
+            
+        if self._type == PDDLAccessors.DOMAIN:
+            return False
+        
+        if self.facts is None:
+            self.facts = FactStore.from_tree(self.get_init_state())
+            
+        return self.facts
+    
     def get_goal(self):
         '''Return the goal state subtree. Return False if goal state subtree not found.'''
         
@@ -185,49 +232,200 @@ class PDDLNode(Node):
             
         return self.goal
         
+class PDDLNode(PDDLAccessors, Node):
+    '''A Node in a PDDL tree, which is has a Lisp-y syntax.'''
+    
+    __slots__ = ("_lazy", )
+    
+    def __init__(self, fname, fn=False):
+        '''Create a new node.
+        fn states whether this is a function or not - used to differentiate between (sum) and sum.'''
+        
+        # call to super
+        Node.__init__(self, fname, fn)
+        
+        self._lazy = None
+        
+class FlatPDDLNode(PDDLAccessors, FlatNode):
+    '''A view of a node in a flat PDDL tree (see flat_tree), with the same accessors as PDDLNode.'''
+    
+    __slots__ = ("_lazy", )
+    
+    def __init__(self, tree, i):
+        '''Create a view of node i of the given FlatTree.'''
+        
+        FlatNode.__init__(self, tree, i)
+        
+        self._lazy = None
+        
+class LazyPDDLNode(PDDLNode):
+    '''A PDDLNode for a section of a PDDL file (like :init), whose subtree is only parsed
+    the first time its children are needed.'''
+    
+    __slots__ = ("_source", "_span")
+    
+    def __init__(self, fname, source, start, end):
+        '''Create a new node for the expression at source[start:end].'''
+        
+        PDDLNode.__init__(self, fname, True)
+        
+        self._source = source
+        self._span = (start, end)
+        # unset, so that the first read goes to __getattr__
+        del self.children
+        
+    def __getattr__(self, attr):
+        '''Parse the section when its children are first asked for.'''
+        
+        if attr != "children":
+            raise AttributeError(attr)
+        
+        start, end = self._span
+        subtree = PDDLParser.get_tree(self._source[start:end])
+        self._source = None
+        
+        self.children = subtree.children
+        for child in self.children:
+            child.parent = self
+        return self.children
+        
+    def copy(self, node_class=None):
+        '''Return a deep copy of this subtree, made of PDDLNodes (the copy is parsed).'''
+        
+        return PDDLNode.copy(self, node_class or PDDLNode)
+        
 class PDDLParser(LispParser):
     
+    # the class of the nodes made by get_tree
+    NODE_CLASS = PDDLNode
+    
+    # finds the parens for the lazy scan, skipping over comments
+    _PAREN_RE = re.compile(r"[()]|;[^\n]*")
+    
     def __init__(self):
         
         LispParser.__init__(self)
         
     @staticmethod
-    def get_tree(expr):
+    def get_tree(expr, flat=False, lazy=False, hashcons=None, cache=None):
         '''Return a DOM-like tree structure. 
-        No need to create a fictitious root since the root element is define.'''
+        No need to create a fictitious root since the root element is define.
+        If flat is set, the tree is stored in a flat_tree.FlatTree, and a FlatPDDLNode view of it is returned.
+        If lazy is set, the sections of the file (:objects, :init, :goal, :action ...) are only parsed
+        when they are first used. The accessors work the same way.
+        If hashcons is a lisp_utils.HashConsTable, identical subtrees are only stored once, and shared.
+        The whole tree is frozen (read-only) then, but the accessors work the same way.
+        If cache is a parse_cache.ParseCache, the tree is loaded from it when the same text was parsed before
+        (only for plain trees: not with flat, lazy or hashcons).'''
         
-        tokens = PDDLParser.get_tokens(expr)
-        #root = PDDLNode(Node.ROOT_NAME, False)
+        if cache is not None and not (flat or lazy or hashcons is not None):
+            return cache.get_tree(expr, PDDLParser)
+        
+        if lazy:
+            if flat or hashcons is not None:
+                raise ValueError("Lazy parsing only makes PDDLNode trees")
+            return PDDLParser._get_lazy_tree(expr)
+        
+        return PDDLParser.build_tree(PDDLParser._events(PDDLParser.get_tokens(expr)), flat, hashcons)
         
-        return PDDLParser._make_lisp_tree_helper(tokens)
-    
     @staticmethod
-    def _make_lisp_tree_helper(tokens):    
-        '''Helper to the make_lisp_tree function. This does most of the work.
-        tokens - list of lisp tokens to make the tree out of.'''
-        
-        token = tokens.pop(0)
-        if token == "(":
-            # consider an empty expression an empty eval exression
-            if tokens[0] == ")":
-                tokens.pop(0)
-                return PDDLNode(Node.EVAL_NAME, True)
-                #return None # a null-child
-            
-            if tokens[0] == "(":
-                # a function call on the stuff inside the next expression
-                root = PDDLNode(Node.EVAL_NAME, True)
+    def _get_lazy_tree(expr):
+        '''Return the root element of the first expression, with a LazyPDDLNode for each section.
+        Only the parens are looked at, to find where each section starts and ends.'''
+        
+        # the first paren which is not in a comment
+        first = -1
+        for match in PDDLParser._PAREN_RE.finditer(expr):
+            if match.group() in "()":
+                first = match.start() if match.group() == "(" else -1
+                break
+        if first < 0 or PDDLParser.get_tokens(expr[:first]):
+            # the first expression is not a list, so there are no sections
+            return PDDLParser.get_tree(expr)
+        
+        # the tokens which are directly in the root element (its name comes first), and the sections
+        items = []
+        depth = 0
+        # where the text directly in the root element started
+        gap = None
+        
+        for match in PDDLParser._PAREN_RE.finditer(expr, first):
+            paren = match.group()
+            if paren == "(":
+                depth += 1
+                if depth == 1:
+                    gap = match.end()
+                elif depth == 2:
+                    items.extend(PDDLParser.get_tokens(expr[gap : match.start()]))
+                    section_start = match.start()
+            elif paren == ")":
+                depth -= 1
+                if depth == 1:
+                    items.append((section_start, match.end()))
+                    gap = match.end()
+                elif depth == 0:
+                    items.extend(PDDLParser.get_tokens(expr[gap : match.start()]))
+                    break
+        else:
+            raise SyntaxError("Missing closing paren")
+        
+        if len(items) > 0 and not isinstance(items[0], tuple):
+            root = PDDLNode(items.pop(0), True)
+        else:
+            # a function call on the stuff inside the next expression, or an empty expression
+            root = PDDLNode(Node.EVAL_NAME, True)
+        
+        for item in items:
+            if isinstance(item, tuple):
+                start, end = item
+                root.add_child(LazyPDDLNode(PDDLParser._section_name(expr, start), expr, start, end))
             else:
-                root = PDDLNode(tokens.pop(0), True)
+                root.add_child(PDDLNode(item, False))
+        
+        return root
+        
+    @staticmethod
+    def _section_name(expr, start):
+        '''Return the name of the expression which starts at expr[start], without parsing the rest of it.'''
+        
+        for match in PDDLParser._TOKEN_RE.finditer(expr, start + 1):
+            token = match.group(1)
+            if token is None:
+                # a comment
+                continue
+            if token in "()":
+                return Node.EVAL_NAME
+            return PDDLParser._GLUED_COMMENT_RE.sub("", token)
+        
+    @staticmethod
+    def get_tree_mapped(fname):
+        '''Return a DOM-like tree structure for the given file, which is memory-mapped instead of read.
+        Same as the LispParser one, but the tree is made of FlatPDDLNode views.'''
+        
+        tree = MappedTree(fname, FlatPDDLNode)
+        return PDDLParser.build_tree(PDDLParser._events(tree.iter_tokens()), tree)
+        
+    @staticmethod
+    def build_tree(events, flat=False, hashcons=None):
+        '''Return a DOM-like tree structure, built from parse events (like the ones from iter_events).
+        Only the first expression is built, the rest of the events are not read.
+        flat can also be an (empty) flat_tree.FlatTree to build into. See get_tree for hashcons.'''
         
-            while tokens[0] != ")":
-                subtree = PDDLParser._make_lisp_tree_helper(tokens)
-                if subtree is not None:
-                    root.add_child(subtree)
+        if flat and hashcons is not None:
+            raise ValueError("Hash-consing only makes PDDLNode trees")
         
-            tokens.pop(0) # remove closing paren
-            return root
-        elif token == ")":
-            raise SyntaxError("Unexpected closing paren")
+        if isinstance(flat, FlatTree):
+            node_class = flat.make_node
         else:
-            return PDDLNode(token, False)
\ No newline at end of file
+            node_class = FlatTree(FlatPDDLNode).make_node if flat else PDDLNode
+        
+        for subtree in PDDLParser._build(events, node_class, hashcons):
+            return subtree
+        raise SyntaxError("No PDDL expression found")
+        
+    @staticmethod
+    def select_subtrees(events, paths, node_class=PDDLNode):
+        '''Same as the LispParser one, but paths start at the root element (define), like the ones for PDDLNode.seek.'''
+        
+        paths = [[(Query.WILDCARD, 0)] + list(path) for path in paths]
+        return LispParser.select_subtrees(events, paths, node_class)
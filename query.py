@@ -0,0 +1,178 @@
+''' A small query language over lisp trees, which answers a batch of paths in one walk of the tree '''
+
+class _State(object):
+	'''One state of the query automaton: the set of (query, step) pairs which are active at a node,
+	with the lookup tables for moving down to the node's children.'''
+
+	__slots__ = ("steps", "matches", "by_name", "anys", "stay", "needs_counts", "dead", "terminal", "memo")
+
+	def __init__(self, query, steps):
+		'''Create the state for the given (closed) frozenset of (query number, step number) pairs.'''
+
+		self.steps = steps
+		# the queries which match the node in this state
+		self.matches = []
+		# name -> list of (ordinal or None, next step)
+		self.by_name = {}
+		# steps for any name: list of (position or None, next step)
+		self.anys = []
+		# descendant steps, which stay active all the way down
+		self.stay = []
+		# whether some step needs the ordinal of a child among the siblings with the same name
+		self.needs_counts = False
+
+		for q, p in steps:
+			path = query.paths[q]
+			if p == len(path):
+				self.matches.append(q)
+				continue
+
+			stop = path[p]
+			if isinstance(stop, tuple):
+				stop, i = stop
+				assert i >= 0
+			else:
+				i = None
+
+			if stop == Query.DESCENDANTS:
+				self.stay.append((q, p))
+			elif stop == Query.WILDCARD:
+				self.anys.append((i, (q, p + 1)))
+			else:
+				self.by_name.setdefault(stop, []).append((i, (q, p + 1)))
+				if i is not None:
+					self.needs_counts = True
+
+		self.matches.sort()
+		self.dead = len(steps) == 0
+		# no child of a node in this state can match anything
+		self.terminal = not (self.by_name or self.anys or self.stay)
+		# name -> next state, for states where the answer only depends on the name
+		self.memo = None if (self.needs_counts or any(i is not None for i, _ in self.anys)) else {}
+
+class Query(object):
+	'''A batch of paths, compiled into one automaton, which finds every path's matches in a single walk of a tree.
+	Paths look like the ones for Node.seek, and can also use these steps:
+		"*" - any child
+		("*", index) - the child at the given position, whatever its name
+		"**" - any number of levels down (including none)
+	Compiled queries are cached, so compiling the same paths again costs nothing.
+	The automaton can also be stepped by hand (start, step), e.g. to follow a stream of parser events.
+	Works on any tree with the Node API (Node, PDDLNode, or a flat_tree.FlatNode view).'''
+
+	WILDCARD = "*"
+	DESCENDANTS = "**"
+
+	# how many compiled queries to keep around
+	CACHE_SIZE = 256
+	_cache = {}
+
+	@staticmethod
+	def compile(paths):
+		'''Return the compiled query for the given list of paths.'''
+
+		key = tuple(tuple(path) for path in paths)
+
+		query = Query._cache.get(key)
+		if query is None:
+			if len(Query._cache) >= Query.CACHE_SIZE:
+				Query._cache.clear()
+			query = Query._cache[key] = Query(key)
+		return query
+
+	def __init__(self, paths):
+		'''Compile the given paths. Use Query.compile instead, which caches the result.'''
+
+		self.paths = paths
+		# closed frozenset of steps -> _State
+		self._states = {}
+		self.start = self._state(set((q, 0) for q in xrange(len(paths))))
+
+	def _state(self, steps):
+		'''Return the state for the given set of (query number, step number) pairs, making it if it's new.'''
+
+		# a descendant step can also match no levels at all, so the next step is active here as well
+		todo = list(steps)
+		steps = set(steps)
+		while todo:
+			q, p = todo.pop()
+			path = self.paths[q]
+			if p < len(path) and path[p] == Query.DESCENDANTS and (q, p + 1) not in steps:
+				steps.add((q, p + 1))
+				todo.append((q, p + 1))
+
+		steps = frozenset(steps)
+		state = self._states.get(steps)
+		if state is None:
+			state = self._states[steps] = _State(self, steps)
+		return state
+
+	def step(self, state, name, k, j):
+		'''Return the state of a child, given the state of its parent.
+		name is the child's name, k its ordinal among the siblings with the same name, and j its position.'''
+
+		memo = state.memo
+		if memo is not None:
+			child_state = memo.get(name)
+			if child_state is not None:
+				return child_state
+
+		steps = set(state.stay)
+		for i, next_step in state.by_name.get(name, ()):
+			if i is None or i == k:
+				steps.add(next_step)
+		for i, next_step in state.anys:
+			if i is None or i == j:
+				steps.add(next_step)
+
+		child_state = self._state(steps)
+		if memo is not None:
+			memo[name] = child_state
+		return child_state
+
+	def run(self, tree, first=False):
+		'''Return a list with the matches of every path, in the same order as the paths.
+		The matches of each path are in document order. The tree's root is where the paths start from.
+		If first is set, stop as soon as every path has a match.'''
+
+		results = [[] for _ in self.paths]
+		missing = len(self.paths)
+
+		stack = [(tree, self.start)]
+		while stack:
+			node, state = stack.pop()
+
+			for q in state.matches:
+				if first and not results[q]:
+					missing -= 1
+				results[q].append(node)
+			if first and missing == 0:
+				break
+
+			if state.terminal:
+				continue
+
+			counts = {} if state.needs_counts else None
+			pending = []
+			for j, child in enumerate(node.children):
+				name = child.name
+				if counts is not None:
+					k = counts.get(name, 0)
+					counts[name] = k + 1
+				else:
+					k = None
+
+				child_state = self.step(state, name, k, j)
+				if not child_state.dead:
+					pending.append((child, child_state))
+
+			# children go on the stack backwards, so they come off in document order
+			pending.reverse()
+			stack.extend(pending)
+
+		return results
+
+	def first(self, tree):
+		'''Return a list with the first match of every path (like Node.seek), or False for paths without a match.'''
+
+		return [(matches[0] if matches else False) for matches in self.run(tree, first=True)]
@@ -1,68 +1,86 @@
-###################################
-#    Written by Shirin Sohrabi    #
-#    Edited by Daniel Kats        #
-#    May 16, 2013                 #
-###################################
-
-import sys
-import os
-
-def remove_existing_files(file_list):
-    '''Delete the existing files in the given list.'''
-    
-    for item in file_list:
-        if os.path.exists(item):
-            os.remove(item)
-
-def partition_translator_output(inputf):
-    '''Take the output of the transaltor and split it into 4 files.
-    Return the filenames as a dictionary:
-        {'axioms'        :    axiom_file,
-         'del_effects'   :    del_effects_file,
-         'add_effects'   :    add_effects_file,
-         'init_states    :    init_state_file
-        }
-    '''
-    
-    infile  = open(inputf, "r")
-    
-    outfiles = {
-        "init_states" : inputf + "_initial_states",
-        "add_effects" : inputf + "_add_effects",
-        "del_effects" : inputf + "_del_effects",
-        "axioms" : inputf + "_axioms"
-    }
-    remove_existing_files(outfiles.values())
-
-    outfile = open(outfiles["init_states"], "w")
-    
-    for line in infile:
-        org = line
-        line = line.strip()
-        
-        if not line or line.startswith("Total No. of states"):
-            continue
-        if line.startswith(";;"):
-            outfile.close()
-            
-            if line==";; initial state":
-                outfile = open(outfiles["init_states"], "a")
-            elif line==";; Add Effects":
-                outfile = open(outfiles["add_effects"], "a")
-            elif line==";; Delete Effects":
-                outfile = open(outfiles["del_effects"], "a")
-            else:
-                outfile = open(outfiles["axioms"], "a")
-        else:
-            outfile.write(org)
-    
-    infile.close()
-    outfile.close()
-    return outfiles
-
-if __name__ == "__main__":
-    partition_translator_output(sys.argv[1])
-
-
-
-
+###################################
+#    Written by Shirin Sohrabi    #
+#    Edited by Daniel Kats        #
+#    May 16, 2013                 #
+###################################
+
+import sys
+import os
+
+def remove_existing_files(file_list):
+    '''Delete the existing files in the given list.'''
+    
+    for item in file_list:
+        if os.path.exists(item):
+            os.remove(item)
+
+# section of the translator output -> suffix of the file it is written to
+SECTION_SUFFIXES = {
+    "init_states" : "_initial_states",
+    "add_effects" : "_add_effects",
+    "del_effects" : "_del_effects",
+    "axioms" : "_axioms"
+}
+
+def split_translator_output(inputf):
+    '''Read the output of the translator once, and split it into its 4 sections, in memory.
+    Return the text of each section as a dictionary, with the same keys as partition_translator_output.'''
+    
+    sections = dict((section, []) for section in SECTION_SUFFIXES)
+    lines = sections["init_states"]
+    
+    infile = open(inputf, "r")
+    
+    for line in infile:
+        org = line
+        line = line.strip()
+        
+        if not line or line.startswith("Total No. of states"):
+            continue
+        if line.startswith(";;"):
+            if line==";; initial state":
+                lines = sections["init_states"]
+            elif line==";; Add Effects":
+                lines = sections["add_effects"]
+            elif line==";; Delete Effects":
+                lines = sections["del_effects"]
+            else:
+                lines = sections["axioms"]
+        else:
+            lines.append(org)
+    
+    infile.close()
+    return dict((section, "".join(lines)) for section, lines in sections.iteritems())
+
+def write_sections(inputf, sections):
+    '''Write the sections from split_translator_output to files named after inputf, after removing the old ones.
+    Empty sections get no file, except for the initial states.
+    Return the filenames of all 4 sections as a dictionary, like partition_translator_output.'''
+    
+    outfiles = dict((section, inputf + suffix) for section, suffix in SECTION_SUFFIXES.iteritems())
+    remove_existing_files(outfiles.values())
+    
+    for section, fname in outfiles.iteritems():
+        # the initial states always get a file, the other sections only when they have lines
+        if not sections[section] and section != "init_states":
+            continue
+        outfile = open(fname, "w")
+        outfile.write(sections[section])
+        outfile.close()
+    
+    return outfiles
+
+def partition_translator_output(inputf):
+    '''Take the output of the transaltor and split it into 4 files.
+    Return the filenames as a dictionary:
+        {'axioms'        :    axiom_file,
+         'del_effects'   :    del_effects_file,
+         'add_effects'   :    add_effects_file,
+         'init_states    :    init_state_file
+        }
+    '''
+    
+    return write_sections(inputf, split_translator_output(inputf))
+
+if __name__ == "__main__":
+    partition_translator_output(sys.argv[1])
@@ -0,0 +1,345 @@
+''' Grounded PDDL atoms, and states packed into bitsets '''
+
+from lisp_utils import Node, SYMBOLS
+from fact_store import FactStore
+from binascii import hexlify, unhexlify
+import itertools
+
+''' The type of objects (and parameters) which don't have one. '''
+OBJECT_TYPE = "object"
+
+''' Numeric effects, which are ignored. '''
+NUMERIC_EFFECTS = ("increase", "decrease", "assign", "scale-up", "scale-down")
+
+''' Numeric comparisons, which are not supported in conditions. (= is only supported between objects.) '''
+NUMERIC_COMPARISONS = ("<", ">", "<=", ">=")
+
+def typed_list(names):
+	'''Return the list of (name, type) in a PDDL typed list, like [?b, -, ball, ?r] -> [(?b, ball), (?r, object)].
+	An (either t1 t2 ...) type is the tuple of its member types, see list_names.'''
+
+	pairs = []
+	# names which don't have their type yet
+	pending = []
+	i = 0
+	while i < len(names):
+		if names[i] == "-" and i + 1 < len(names):
+			pairs.extend((name, names[i + 1]) for name in pending)
+			pending = []
+			i += 2
+		else:
+			pending.append(names[i])
+			i += 1
+	pairs.extend((name, OBJECT_TYPE) for name in pending)
+	return pairs
+
+def list_names(node):
+	'''Return the names in a parsed list like (?a ?b - t), which the parser stores as ?a with children ?b, -, t.
+	An (either t1 t2 ...) in the list is the tuple (t1, t2 ...). An empty list () is an eval node without children.'''
+
+	if node.name == Node.EVAL_NAME and not node.children:
+		return []
+	names = [node.name]
+	for child in node.children:
+		if child.fn and child.name == "either":
+			names.append(tuple([member.name for member in child.children]))
+		else:
+			names.append(child.name)
+	return names
+
+def type_name(t):
+	'''Return the PDDL text of a type from typed_list, like ball, or (either ball box).'''
+
+	return "(either %s)" % " ".join(t) if isinstance(t, tuple) else t
+
+def section_after(node, key):
+	'''Return the child which follows the child named key (like :parameters, :effect), or None.'''
+
+	for i, child in enumerate(node.children):
+		if child.name == key and not child.fn:
+			return node.children[i + 1] if i + 1 < len(node.children) else None
+	return None
+
+def atom_names(node):
+	'''Return the (predicate, arg1, ...) names of an atom node like (at ?b ?r).'''
+
+	return tuple([node.name] + [child.name for child in node.children])
+
+def conjuncts(node):
+	'''Return the list of the conjuncts of the given (and ...) tree, nested ands included, or [] for a missing or empty one.'''
+
+	if node is None:
+		return []
+	found = []
+	stack = [node]
+	while stack:
+		node = stack.pop()
+		if node.name == "and":
+			stack.extend(reversed(node.children))
+		elif node.name == Node.EVAL_NAME and not node.children:
+			# an empty ()
+			continue
+		elif node.fn or node.children:
+			found.append(node)
+	return found
+
+def literals(node, positive=True):
+	'''Return the list of (positive, atom names) in a condition or effect, like (and (p ?x) (not (q ?x))).
+	Atoms under other connectives (or, forall, when ...) are all returned, as seen from the atom's own (not).'''
+
+	found = []
+	stack = [(node, positive)]
+	while stack:
+		node, positive = stack.pop()
+		if node is None or not node.fn:
+			continue
+		if node.name == "and" or node.name == Node.EVAL_NAME:
+			stack.extend((child, positive) for child in reversed(node.children))
+		elif node.name == "not":
+			stack.extend((child, not positive) for child in reversed(node.children))
+		elif node.name in ("forall", "exists"):
+			# the first child is the list of variables
+			stack.extend((child, positive) for child in reversed(node.children[1:]))
+		elif node.name in ("or", "imply", "when"):
+			stack.extend((child, positive) for child in reversed(node.children))
+		elif node.name != "=" and node.name not in NUMERIC_EFFECTS:
+			found.append((positive, atom_names(node)))
+	return found
+
+class TypedObjects(object):
+	'''The objects of a problem (with the domain's constants), and the type hierarchy of the domain.'''
+
+	def __init__(self, domain_tree, problem_tree):
+		'''Read the types, constants and objects of the given domain and problem trees.'''
+
+		# type -> its parent types (a type declared as - (either t1 t2) has both as parents)
+		self._supertypes = {}
+		types = domain_tree.seek([":types"])
+		if types:
+			for name, parent in typed_list(list_names(types)[1:]):
+				self._supertypes.setdefault(name, []).extend(parent if isinstance(parent, tuple) else [parent])
+
+		# list of (object name, type)
+		self.objects = []
+		for section in [domain_tree.seek([":constants"]), problem_tree.seek([":objects"])]:
+			if section:
+				self.objects.extend(typed_list(list_names(section)[1:]))
+
+	def is_a(self, t, target):
+		'''Return whether type t is target, or a subtype of it.
+		An (either ...) target matches a subtype of any of its members, and so does an (either ...) t.'''
+
+		if isinstance(target, tuple):
+			return any(self.is_a(t, member) for member in target)
+		if isinstance(t, tuple):
+			return any(self.is_a(member, target) for member in t)
+
+		seen = set()
+		todo = [t]
+		while todo:
+			t = todo.pop()
+			if t == target or target == OBJECT_TYPE:
+				return True
+			if t not in seen:
+				seen.add(t)
+				todo.extend(self._supertypes.get(t, ()))
+		return False
+
+	def objects_of(self, t):
+		'''Return the names of the objects of type t (or of its subtypes). For an (either ...) type, the objects of any member.'''
+
+		return [name for name, object_type in self.objects if self.is_a(object_type, t)]
+
+class AtomCatalogue(object):
+	'''The grounded atoms of a problem, each with a bit position, so that a state is one int (a bitset):
+		- bit i is set if atoms[i] is true
+		- states hash and compare like ints, and applying an action is (state & ~delete) | add
+	The atoms are the ones that can ever be true, found without a full grounding:
+		- static predicates (not in any effect) only have the atoms in :init
+		- the effect atoms of every action, where each parameter ranges over the objects of its type
+		  which also have every static unary precondition of the parameter, like (ball ?obj)
+		- the atoms in :init and the (positive) atoms in :goal
+	Or pass the atoms to use (tuples of names), e.g. the reachable ones from a grounder.'''
+
+	def __init__(self, domain_tree, problem_tree, atoms=None):
+		'''Build the catalogue for the given domain and problem trees.'''
+
+		self.domain_tree = domain_tree
+		self.problem_tree = problem_tree
+
+		# predicate name -> list of (parameter, type)
+		self.predicates = {}
+		# a domain doesn't need a :predicates section
+		predicates = domain_tree.get_predicates()
+		for node in (predicates.children if predicates else []):
+			self.predicates[node.name] = typed_list(list_names(node)[1:])
+
+		self.types = TypedObjects(domain_tree, problem_tree)
+		# list of (object name, type), with the domain's constants
+		self.objects = self.types.objects
+
+		# every atom, as a tuple of SYMBOLS ids, and its bit
+		self.atoms = []
+		self.bits = {}
+
+		if atoms is None:
+			atoms = self._find_atoms()
+		for atom in atoms:
+			self._add(tuple([SYMBOLS.id_of(name) for name in atom]))
+
+	def __len__(self):
+		return len(self.atoms)
+
+	def _add(self, atom):
+		'''Give the given atom (a tuple of ids) the next bit, if it doesn't have one.'''
+
+		if atom not in self.bits:
+			self.bits[atom] = len(self.atoms)
+			self.atoms.append(atom)
+
+	def objects_of(self, t):
+		'''Return the names of the objects of type t (or of its subtypes).'''
+
+		return self.types.objects_of(t)
+
+	def _find_atoms(self):
+		'''Return the list of atoms (tuples of names) that can ever be true, see the class.'''
+
+		facts = self.problem_tree.get_facts()
+		actions = list(self.domain_tree.get_actions())
+
+		effects = [literals(section_after(action, ":effect")) for action in actions]
+		fluent = set(atom[0] for action_effects in effects for _, atom in action_effects)
+
+		atoms = []
+		for action, action_effects in zip(actions, effects):
+			parameters = section_after(action, ":parameters")
+			parameters = typed_list(list_names(parameters)) if parameters is not None else []
+
+			candidates = {}
+			for parameter, t in parameters:
+				candidates[parameter] = self.objects_of(t)
+
+			# narrow the parameters down with static unary preconditions, like (ball ?obj)
+			for conjunct in conjuncts(section_after(action, ":precondition")):
+				atom = atom_names(conjunct)
+				if len(atom) == 2 and atom[0] not in fluent and atom[1] in candidates and not conjunct.children[0].fn:
+					holds = set(fact[1] for fact in facts.match((atom[0], None)))
+					candidates[atom[1]] = [name for name in candidates[atom[1]] if name in holds]
+
+			for _, atom in action_effects:
+				# variables which are not parameters (forall ...) range over all objects
+				choices = [candidates.get(arg, [name for name, _ in self.objects]) if arg.startswith("?") else [arg]
+					for arg in atom[1:]]
+				for args in itertools.product(*choices):
+					atoms.append((atom[0],) + args)
+
+		atoms.extend(facts)
+		for node in self.problem_tree.get_goal().children:
+			atoms.extend(atom for positive, atom in literals(node) if positive)
+		return atoms
+
+	def bit(self, atom):
+		'''Return the bit of the given atom (a tuple of names), or None if it is not in the catalogue.'''
+
+		atom = FactStore.encode(atom)
+		return None if atom is None else self.bits.get(atom)
+
+	def atom(self, bit):
+		'''Return the atom (a tuple of names) of the given bit.'''
+
+		return FactStore.decode(self.atoms[bit])
+
+	def mask(self, atoms):
+		'''Return the bitset with the given atoms (tuples of names). Raise KeyError for an atom which is not in the catalogue.'''
+
+		mask = 0
+		for atom in atoms:
+			bit = self.bit(atom)
+			if bit is None:
+				raise KeyError(atom)
+			mask |= 1 << bit
+		return mask
+
+	def mask_ids(self, atoms):
+		'''Same as mask, for atoms which are tuples of ids.'''
+
+		bits = self.bits
+		mask = 0
+		for atom in atoms:
+			mask |= 1 << bits[atom]
+		return mask
+
+	def decode(self, state):
+		'''Return the list of atoms (tuples of names) which are true in the given state, in bit order.'''
+
+		found = []
+		# one byte at a time, so that sparse states skip most of their bits quickly
+		data = bytearray(self.to_bytes(state))
+		last = len(data) - 1
+		for i, byte in enumerate(data):
+			if byte:
+				base = (last - i) * 8
+				for j in xrange(8):
+					if byte & (1 << j):
+						found.append(base + j)
+		found.sort()
+		return [self.atom(bit) for bit in found]
+
+	def init_state(self):
+		'''Return the initial state of the problem. Atoms of :init that are not in the catalogue are left out.'''
+
+		bits = self.bits
+		state = 0
+		for fact in self.problem_tree.get_facts().facts:
+			bit = bits.get(fact)
+			if bit is not None:
+				state |= 1 << bit
+		return state
+
+	def goal_mask(self):
+		'''Return the bitset of the goal, for a goal which is a conjunction of atoms.
+		Raise ValueError for other goals (negations, disjunctions ...).'''
+
+		goal = self.problem_tree.get_goal()
+		atoms = []
+		stack = list(goal.children)
+		while stack:
+			node = stack.pop()
+			if node.name == "and":
+				stack.extend(node.children)
+			elif node.name in ("not", "or", "imply", "forall", "exists") or any(child.fn for child in node.children):
+				raise ValueError("Goal is not a conjunction of atoms: %s" % node.to_lisp())
+			else:
+				atoms.append(atom_names(node))
+		return self.mask(atoms)
+
+	@staticmethod
+	def apply(state, add, delete):
+		'''Return the state after an action with the given add and delete bitsets (deletes first, like STRIPS).'''
+
+		return (state & ~delete) | add
+
+	@staticmethod
+	def holds(state, mask):
+		'''Return whether every atom of the mask is true in the state.'''
+
+		return state & mask == mask
+
+	def width(self):
+		'''Return the number of bytes of a packed state.'''
+
+		return (len(self.atoms) + 7) // 8
+
+	def to_bytes(self, state):
+		'''Return the given state packed into a string of width() bytes (big-endian).'''
+
+		if self.width() == 0:
+			# "%0*x" would give "0", which is not a whole byte
+			return ""
+		return unhexlify("%0*x" % (self.width() * 2, state))
+
+	def from_bytes(self, data):
+		'''Return the state packed in the given string (see to_bytes).'''
+
+		return int(hexlify(data), 16) if data else 0
@@ -1,10 +1,18 @@
-#from lisp_utils import LispParser
-from pddl_utils import PDDLParser as Parser
+from lisp_utils import LispParser, Node, SYMBOLS, HashConsTable
+from pddl_utils import PDDLParser as Parser, PDDLNode
 from compare import LispDiff
+from parse_cache import ParseCache
+from states import AtomCatalogue
+from grounder import Grounder
+from conditions import ConditionCompiler, CompiledAction, evaluate, apply_effect
+from validator import PlanValidator
 from utils import get_contents
 
 #from timeit import timeit
 import time
+import resource
+import os
+import sys
 
 '''
 This file runs tests on the PDDL parser.
@@ -16,7 +24,7 @@ def profile_tree(fname):
     
     contents = get_contents(fname)
     parser = Parser()
-    tree = parser.get_tree(contents)
+    tree = parser.get_tree(contents, cache=ParseCache.from_environment())
     
     print "==> tree-type:",
     t = tree.get_type()
@@ -70,8 +78,727 @@ def benchmark_seek_all():
     #for i in xrange(1):
     tree.seek_all_list([':action'])
     print (time.time() - start) #* 1000
-   
-   
+    
+def make_gripper_domain(n_actions):
+    '''Return the text of a gripper-like domain with n_actions :action blocks, for benchmarks.'''
+    
+    lines = ["(define (domain gripper-x-%d)" % n_actions]
+    lines.append("\t(:predicates (room ?r) (ball ?b) (gripper ?g) (at-robby ?r) (at ?b ?r) (free ?g) (carry ?o ?g))")
+    for i in xrange(n_actions):
+        lines.append("\t(:action pick-%d" % i)
+        lines.append("\t\t:parameters (?obj ?room ?gripper)")
+        lines.append("\t\t:precondition (and (ball ?obj) (room ?room) (gripper ?gripper) (at ?obj ?room) (at-robby ?room) (free ?gripper))")
+        lines.append("\t\t:effect (and (carry ?obj ?gripper) (not (at ?obj ?room)) (not (free ?gripper)))")
+        lines.append("\t)")
+    lines.append(")")
+    return "\n".join(lines)
+    
+def benchmark_child_index(n_actions=5000):
+    '''Time seek lookups on a domain with many :action blocks, with and without the per-node child-name index.'''
+    
+    tree = Parser.get_tree(make_gripper_domain(n_actions))
+    actions = list(tree.get_actions())
+    min_children = Node.INDEX_MIN_CHILDREN
+    
+    for label, threshold in [("scan", sys.maxint), ("index", min_children)]:
+        Node.INDEX_MIN_CHILDREN = threshold
+        tree._index = None
+        
+        start = time.time()
+        for i in xrange(0, n_actions, max(1, n_actions / 500)):
+            tree.seek([(":action", i), ":parameters"])
+            tree.index_of(actions[i])
+        tree.seek([":predicates"])
+        for action in tree.get_actions():
+            action.get_parameters()
+            action.get_preconditions()
+            action.get_effects()
+        print "==> %s: %.3f s" % (label, time.time() - start)
+    
+    Node.INDEX_MIN_CHILDREN = min_children
+    
+def benchmark_nesting_depth(depths=(10, 1000, 100000), n_tokens=1000000):
+    '''Show parser throughput on expressions nested to the given depths.
+    Each input has roughly n_tokens tokens, so the numbers are comparable.'''
+    
+    for depth in depths:
+        # an expression like (f (f (f x))), repeated to fill up n_tokens
+        expr = "(f " * depth + "x" + ")" * depth
+        expr = "\n".join([expr] * max(1, n_tokens / (3 * depth + 1)))
+        
+        # counted before the timing, so the input is only tokenized once in the timed part
+        n = len(LispParser.get_tokens(expr))
+        
+        start = time.time()
+        tree = LispParser.get_tree(expr)
+        elapsed = time.time() - start
+        
+        print "==> depth %d: %d tokens in %.3f s (%d tokens / s)" % (depth, n, elapsed, n / elapsed)
+
+def make_gripper_problem(n_balls):
+    '''Return the text of a gripper problem with n_balls balls, for benchmarks.'''
+    
+    balls = ["ball%d" % i for i in xrange(n_balls)]
+    
+    lines = ["(define", "\t(problem strips-gripper-x-%d)" % n_balls, "\t(:domain gripper-strips)"]
+    lines.append("\t(:objects rooma roomb left right %s)" % " ".join(balls))
+    lines.append("\t(:init (room rooma) (room roomb) (gripper left) (gripper right) (at-robby rooma) (free left) (free right)")
+    for ball in balls:
+        lines.append("\t\t(ball %s) (at %s rooma)" % (ball, ball))
+    lines.append("\t)")
+    lines.append("\t(:goal (and %s))" % " ".join(["(at %s roomb)" % ball for ball in balls]))
+    lines.append(")")
+    return "\n".join(lines)
+    
+def peak_rss(f, *args):
+    '''Run f(*args) in a forked child process.
+    Return how much the peak RSS (in KB) of that process grew while running f.'''
+    
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # the child must never return into the caller's code, even if f raises
+        status = 1
+        try:
+            os.close(r)
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            f(*args)
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, str(after - before))
+            status = 0
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    
+    os.close(w)
+    output = os.read(r, 64)
+    os.close(r)
+    _, status = os.waitpid(pid, 0)
+    if status != 0 or not output:
+        raise RuntimeError("peak_rss: %s failed in the child process" % getattr(f, "__name__", f))
+    return int(output)
+    
+class _LegacyNode(object):
+    '''The node layout from before Node had __slots__, for comparison:
+    a __dict__ per node, and a time-salted hash.'''
+    
+    def __init__(self, fname, fn=False):
+        self.name = fname
+        self.parent = None
+        self.children = []
+        self.fn = fn
+        self.hash = hash(fname + str(time.time()))
+        self.root = (fname == Node.ROOT_NAME)
+        
+    def add_child(self, node):
+        node.parent = self
+        self.children.append(node)
+        
+class _LegacyPDDLNode(_LegacyNode):
+    
+    def __init__(self, fname, fn=False):
+        _LegacyNode.__init__(self, fname, fn)
+        self.problem = None
+        self.domain = None
+        self.init_state = None
+        self.goal = None
+        self._type = None
+    
+def benchmark_node_memory(n_balls=100000):
+    '''Compare memory and build time of the node classes against the legacy layout,
+    on a synthetic gripper problem.'''
+    
+    tokens = LispParser.get_tokens(make_gripper_problem(n_balls))
+    print "==> %d tokens" % len(tokens)
+    
+    def build(node_class):
+        return LispParser._build(LispParser._events(tokens), node_class).next()
+    
+    node_classes = [_LegacyNode, Node, _LegacyPDDLNode, PDDLNode]
+    
+    # measure memory before building anything here, so that the children start out clean
+    growth = [peak_rss(build, node_class) for node_class in node_classes]
+    
+    for node_class, kb in zip(node_classes, growth):
+        start = time.time()
+        build(node_class)
+        elapsed = time.time() - start
+        
+        print "==> %s: %d KB peak, built in %.3f s" % (node_class.__name__, kb, elapsed)
+
+def benchmark_backend_memory(n_balls=100000):
+    '''Report peak RSS and parse time of the Node and flat backends, on the same synthetic gripper problem.'''
+    
+    problem = make_gripper_problem(n_balls)
+    
+    # measure memory before parsing anything here, so that the children start out clean
+    growth = [peak_rss(Parser.get_tree, problem, flat) for flat in [False, True]]
+    
+    for flat, kb in zip([False, True], growth):
+        start = time.time()
+        Parser.get_tree(problem, flat)
+        elapsed = time.time() - start
+        
+        print "==> %s backend: %d KB peak, parsed in %.3f s" % ("flat" if flat else "node", kb, elapsed)
+
+def benchmark_symbol_interning(n_balls=100000):
+    '''Show how much memory the shared symbol table saves on node names,
+    for a synthetic gripper problem parsed together with the gripper domain.'''
+    
+    trees = [Parser.get_tree(get_contents(f_domain)), Parser.get_tree(make_gripper_problem(n_balls))]
+    
+    n_nodes = own_bytes = 0
+    shared = {}
+    stack = list(trees)
+    while stack:
+        node = stack.pop()
+        n_nodes += 1
+        # what the name would cost if every node had its own copy, like the tokens do
+        own_bytes += sys.getsizeof(node.name)
+        shared[id(node.name)] = sys.getsizeof(node.name)
+        stack.extend(node.children)
+    
+    shared_bytes = sum(shared.values())
+    print "==> %d nodes, %d distinct names (%d in the symbol table)" % (n_nodes, len(shared), len(SYMBOLS))
+    print "==> name strings: %d KB with a copy per node, %d KB interned (%d KB saved)" % \
+        (own_bytes / 1024, shared_bytes / 1024, (own_bytes - shared_bytes) / 1024)
+
+def benchmark_streaming(n_balls=100000):
+    '''Compare peak RSS of parsing a whole synthetic problem file,
+    and of streaming it to build only the :goal and :objects subtrees.'''
+    
+    fname = "bench_problem.pddl"
+    fp = open(fname, "w")
+    fp.write(make_gripper_problem(n_balls))
+    fp.close()
+    
+    def whole():
+        tree = Parser.get_tree(get_contents(fname))
+        return tree.get_goal(), tree.seek([":objects"])
+    
+    def streamed():
+        fp = open(fname)
+        subtrees = list(Parser.select_subtrees(Parser.iter_events(fp), [[":goal"], [":objects"]]))
+        fp.close()
+        return subtrees
+    
+    for label, f in [("whole tree", whole), ("streamed", streamed)]:
+        kb = peak_rss(f)
+        start = time.time()
+        f()
+        print "==> %s: %d KB peak, %.3f s" % (label, kb, time.time() - start)
+    
+    os.remove(fname)
+
+def write_gripper_problem(fname, size_mb):
+    '''Write a gripper problem of about size_mb MB to the given file, for benchmarks.
+    Like make_gripper_problem, but written a bit at a time, so the text is never all in memory.'''
+    
+    # each ball costs about this many bytes
+    n_balls = size_mb * 1024 * 1024 / 56
+    step = 10000
+    
+    fp = open(fname, "w")
+    fp.write("(define\n\t(problem strips-gripper-x-%d)\n\t(:domain gripper-strips)\n\t(:objects rooma roomb left right" % n_balls)
+    for i in xrange(0, n_balls, step):
+        fp.write(" " + " ".join(["ball%d" % j for j in xrange(i, min(i + step, n_balls))]))
+    fp.write(")\n\t(:init (room rooma) (room roomb) (gripper left) (gripper right) (at-robby rooma) (free left) (free right)\n")
+    for i in xrange(0, n_balls, step):
+        fp.write("".join(["\t\t(ball ball%d) (at ball%d rooma)\n" % (j, j) for j in xrange(i, min(i + step, n_balls))]))
+    fp.write("\t)\n\t(:goal (and (at ball0 roomb)))\n)")
+    fp.close()
+    
+def benchmark_mapped_input(size_mb=300):
+    '''Compare peak RSS and time of parsing a synthetic problem file of about size_mb MB,
+    read with get_contents, and memory-mapped.'''
+    
+    fname = "bench_problem.pddl"
+    write_gripper_problem(fname, size_mb)
+    print "==> %d MB file" % (os.path.getsize(fname) / (1024 * 1024))
+    
+    def goal(tree):
+        # read something from the tree, so mapped names get used
+        return tree.get_goal().to_lisp()
+    
+    runs = [
+        ("get_contents, node tree", lambda: goal(Parser.get_tree(get_contents(fname)))),
+        ("get_contents, flat tree", lambda: goal(Parser.get_tree(get_contents(fname), True))),
+        ("memory-mapped", lambda: goal(Parser.get_tree_mapped(fname))),
+    ]
+    
+    for label, f in runs:
+        start = time.time()
+        kb = peak_rss(f)
+        print "==> %s: %d KB peak, %.3f s" % (label, kb, time.time() - start)
+    
+    os.remove(fname)
+
+def benchmark_lazy_sections(n_balls=100000):
+    '''Time getting the domain, problem and goal of a synthetic problem, with eager and lazy parsing.
+    Then check that both give the same tree, for the problem and for a copy with parens in its comments.'''
+    
+    problem = make_gripper_problem(n_balls)
+    
+    for lazy in [False, True]:
+        start = time.time()
+        tree = Parser.get_tree(problem, lazy=lazy)
+        tree.get_domain()
+        tree.get_problem()
+        tree.get_goal()
+        print "==> %s: %.3f s" % ("lazy" if lazy else "eager", time.time() - start)
+    
+    commented = ";; gripper (strips) problem\n;; unbalanced (paren\n" + \
+        problem.replace("(:init", "(:init ; note (x ...\n", 1) + "\n; trailing ( comment"
+    for label, text in [("plain", problem), ("commented", commented)]:
+        same = Parser.get_tree(text, lazy=True).to_lisp() == Parser.get_tree(text).to_lisp()
+        print "==> %s: lazy tree %s" % (label, "matches" if same else "DOES NOT match")
+
+def benchmark_serialize(n_balls=100000, depth=5000):
+    '''Compare time and peak RSS of serializing a synthetic problem with to_lisp and with write_lisp,
+    and time serializing an expression nested to the given depth.'''
+    
+    tree = Parser.get_tree(make_gripper_problem(n_balls))
+    fname = "bench_out.lisp"
+    
+    def whole():
+        fp = open(fname, "w")
+        fp.write(tree.to_lisp())
+        fp.close()
+    
+    def streamed():
+        fp = open(fname, "w")
+        tree.write_lisp(fp)
+        fp.close()
+    
+    for label, f in [("to_lisp", whole), ("write_lisp", streamed)]:
+        kb = peak_rss(f)
+        start = time.time()
+        f()
+        print "==> %s: %d KB peak, %.3f s" % (label, kb, time.time() - start)
+    
+    os.remove(fname)
+    
+    # every level is a multi-line expression, so the text is indented all the way down
+    expr = "(f " * depth + "(x)" + ")" * depth
+    deep = LispParser.get_tree(expr)
+    start = time.time()
+    text = deep.to_lisp()
+    print "==> depth %d: %d chars in %.3f s" % (depth, len(text), time.time() - start)
+
+def benchmark_incremental_serialize(sizes=(1000, 4000, 16000), edits=(1, 10, 100)):
+    '''Time re-serializing a synthetic domain with cached rendering, after renaming a few of its operators.
+    Re-serializing should depend on the number of edits, and only a little on the size of the domain.'''
+    
+    for n_actions in sizes:
+        tree = Parser.get_tree(make_gripper_domain(n_actions))
+        actions = tree.seek_all_list([":action"])
+        
+        start = time.time()
+        tree.to_lisp()
+        print "==> %d operators: %.3f s uncached" % (n_actions, time.time() - start)
+        
+        tree.to_lisp(cache=True)
+        for n_edits in edits:
+            for action in actions[:n_edits]:
+                action.children[0].name += "-x"
+            
+            start = time.time()
+            tree.to_lisp(cache=True)
+            print "    %d edited: %.4f s cached" % (n_edits, time.time() - start)
+
+def benchmark_shared_ornaments(n_actions=5000, n_effects=50):
+    '''Compare peak RSS and time of hanging the same effects on every operator of a synthetic domain,
+    by copying them for each operator, and by sharing one frozen copy.'''
+    
+    domain = make_gripper_domain(n_actions)
+    ornament = " ".join(["(effect-%d ?obj ?room)" % i for i in xrange(n_effects)])
+    
+    def hang(share):
+        tree = Parser.get_tree(domain)
+        effects = LispParser.get_tree(ornament)
+        if share:
+            effects.freeze()
+        
+        for action in tree.seek_all([":action"]):
+            action.merge_tree(effects if share else effects.copy())
+        return tree
+    
+    for label, share in [("copied", False), ("shared", True)]:
+        kb = peak_rss(hang, share)
+        start = time.time()
+        hang(share)
+        print "==> %s: %d KB peak, %.3f s" % (label, kb, time.time() - start)
+
+def benchmark_hashcons(n_actions=20000, n_balls=100000):
+    '''Compare peak RSS and parse time with and without hash-consing,
+    on a synthetic domain (whose operators repeat the same subtrees) and problem.
+    Also show the deduplication report.'''
+    
+    for label, text in [("domain", make_gripper_domain(n_actions)), ("problem", make_gripper_problem(n_balls))]:
+        for hashcons in [False, True]:
+            def parse():
+                return Parser.get_tree(text, hashcons=(HashConsTable() if hashcons else None))
+            
+            kb = peak_rss(parse)
+            table = HashConsTable() if hashcons else None
+            start = time.time()
+            Parser.get_tree(text, hashcons=table)
+            print "==> %s, %s: %d KB peak, %.3f s" % (label, "hash-consed" if hashcons else "plain", kb, time.time() - start)
+            if hashcons:
+                print "    " + table.report()
+
+def benchmark_fingerprint(n_balls=100000, n_edits=10):
+    '''Time fingerprinting a synthetic problem, fingerprinting it again after a few edits,
+    and comparing it with a second parse of the same text.'''
+    
+    problem = make_gripper_problem(n_balls)
+    tree = Parser.get_tree(problem)
+    
+    start = time.time()
+    tree.fingerprint()
+    print "==> first fingerprint: %.3f s" % (time.time() - start)
+    
+    facts = tree.get_init_state().children
+    for i in xrange(n_edits):
+        facts[i * len(facts) / n_edits].children[0].name = "edited"
+    
+    start = time.time()
+    tree.fingerprint()
+    print "==> after %d edits: %.4f s" % (n_edits, time.time() - start)
+    
+    other = Parser.get_tree(problem)
+    other.fingerprint()
+    start = time.time()
+    equal = tree.get_goal().structurally_equal(other.get_goal()), tree.structurally_equal(other)
+    print "==> goal equal: %s, tree equal: %s, compared in %.6f s" % (equal + (time.time() - start, ))
+
+def benchmark_tree_diff(n_balls=100000):
+    '''Time the token compare and the tree diff on a synthetic problem file and a copy of it
+    with a few changes (a changed fact, a few inserted facts and a deleted fact).'''
+    
+    f_baseline, f_generated = "bench_baseline.pddl", "bench_generated.pddl"
+    problem = make_gripper_problem(n_balls)
+    
+    fp = open(f_baseline, "w")
+    fp.write(problem)
+    fp.close()
+    
+    changed = problem.replace("(at ball10 rooma)", "(at ball10 roomb)", 1)
+    changed = changed.replace("(ball ball500)", "(ball ball500) (ball extra1) (ball extra2) (ball extra3)", 1)
+    changed = changed.replace("(ball ball90000)", "", 1)
+    fp = open(f_generated, "w")
+    fp.write(changed)
+    fp.close()
+    
+    print "==> %d KB files" % (os.path.getsize(f_baseline) / 1024)
+    
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    start = time.time()
+    LispDiff.compare(f_baseline, f_generated)
+    elapsed = time.time() - start
+    sys.stdout = stdout
+    print "==> token compare: %.3f s" % elapsed
+    
+    start = time.time()
+    edits = LispDiff.diff(f_baseline, f_generated)
+    print "==> tree diff: %d edits in %.3f s" % (len(edits), time.time() - start)
+    for edit in edits:
+        print "    %s" % edit
+    
+    os.remove(f_baseline)
+    os.remove(f_generated)
+
+def benchmark_compare_dirs(n_files=40, n_balls=5000):
+    '''Time comparing two directories of synthetic problems (one file in ten is different),
+    by running compare.py once per pair, and with LispDiff.compare_dirs.'''
+    
+    import shutil
+    import subprocess
+    import tempfile
+    
+    base_dir, gen_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+    problem = make_gripper_problem(n_balls)
+    
+    for i in xrange(n_files):
+        for directory, text in [(base_dir, problem), (gen_dir, problem if i % 10 else problem.replace("rooma", "roomc", 1))]:
+            fp = open(os.path.join(directory, "Problem%d.lisp" % i), "w")
+            fp.write(text)
+            fp.close()
+    
+    devnull = open(os.devnull, "w")
+    start = time.time()
+    for i in xrange(n_files):
+        name = "Problem%d.lisp" % i
+        subprocess.call([sys.executable, "compare.py", os.path.join(base_dir, name), os.path.join(gen_dir, name)], stdout=devnull)
+    print "==> one compare.py per pair: %.3f s" % (time.time() - start)
+    
+    start = time.time()
+    summary = LispDiff.compare_dirs(base_dir, gen_dir)
+    print "==> compare_dirs: %d passed, %d failed in %.3f s" % (summary["passed"], summary["failed"], time.time() - start)
+    
+    shutil.rmtree(base_dir)
+    shutil.rmtree(gen_dir)
+
+def benchmark_parse_cache(n_balls=100000):
+    '''Time parsing a large synthetic problem, against loading it from a ParseCache (cold, then warm),
+    and loading from an entry which was damaged.'''
+    
+    import shutil
+    import tempfile
+    
+    problem = make_gripper_problem(n_balls)
+    directory = tempfile.mkdtemp()
+    cache = ParseCache(directory)
+    
+    start = time.time()
+    tree = Parser.get_tree(problem)
+    print "==> parse: %.3f s" % (time.time() - start)
+    
+    for label in ["cold cache (parse and store)", "warm cache (load)"]:
+        start = time.time()
+        cached = Parser.get_tree(problem, cache=cache)
+        print "==> %s: %.3f s" % (label, time.time() - start)
+    print "==> same tree: %s" % (cached.to_lisp() == tree.to_lisp())
+    
+    # damage the entry: it's removed, and the text is parsed again
+    path = os.path.join(directory, os.listdir(directory)[0])
+    fp = open(path, "r+b")
+    fp.seek(os.path.getsize(path) // 2)
+    fp.write("garbage")
+    fp.close()
+    start = time.time()
+    Parser.get_tree(problem, cache=cache)
+    print "==> corrupt entry (parse again): %.3f s" % (time.time() - start)
+    print "==> hits %d, misses %d, corrupt %d, entry size %d bytes" % (cache.hits, cache.misses, cache.corrupt, os.path.getsize(path))
+    
+    shutil.rmtree(directory)
+
+def benchmark_fact_store(n_balls=200000, n_queries=100):
+    '''Time building the FactStore of a large synthetic problem, and answering queries with it,
+    against scanning the :init subtree.'''
+    
+    tree = Parser.get_tree(make_gripper_problem(n_balls))
+    init = tree.get_init_state()
+    balls = ["ball%d" % (i + 1) for i in xrange(0, n_balls, max(1, n_balls // n_queries))]
+    
+    start = time.time()
+    facts = tree.get_facts()
+    print "==> built the store of %d facts in %.3f s" % (len(facts), time.time() - start)
+    
+    def scan(ball):
+        return [tuple([child.name] + [arg.name for arg in child.children]) for child in init.children
+            if child.name == "at" and len(child.children) == 2 and child.children[0].name == ball]
+    
+    for label, where in [("scan :init", scan), ("FactStore.match", lambda ball: facts.match(("at", ball, None)))]:
+        start = time.time()
+        found = sum(len(where(ball)) for ball in balls)
+        print "==> %s: %d 'at' lookups (%d found) in %.3f s" % (label, len(balls), found, time.time() - start)
+    
+    start = time.time()
+    found = sum(1 for ball in balls if ("at", ball, "rooma") in facts)
+    print "==> %d membership tests (%d true) in %.3f s" % (len(balls), found, time.time() - start)
+
+def benchmark_bitset_states(n_balls=500, n_steps=100):
+    '''Time a random walk over the states of a gripper problem with n_balls balls (from the sample domain),
+    with states as AtomCatalogue bitsets, against frozensets of atoms.
+    Every state of the walk is expanded: every ground action is checked, and each applicable one makes a successor.'''
+    
+    import random
+    
+    domain = Parser.get_tree(get_contents(f_domain))
+    problem = Parser.get_tree(make_gripper_problem(n_balls))
+    
+    start = time.time()
+    catalogue = AtomCatalogue(domain, problem)
+    print "==> catalogue of %d atoms in %.3f s, %d bytes per state" % (len(catalogue), time.time() - start, catalogue.width())
+    
+    # the ground actions, as (preconditions, adds, deletes), by hand
+    rooms, grippers = ["rooma", "roomb"], ["left", "right"]
+    balls = ["ball%d" % i for i in xrange(n_balls)]
+    actions = [([("at-robby", a)], [("at-robby", b)], [("at-robby", a)]) for a in rooms for b in rooms if a != b]
+    for ball in balls:
+        for room in rooms:
+            for gripper in grippers:
+                actions.append(([("at", ball, room), ("at-robby", room), ("free", gripper)],
+                    [("carry", ball, gripper)], [("at", ball, room), ("free", gripper)]))
+                actions.append(([("carry", ball, gripper), ("at-robby", room)],
+                    [("at", ball, room), ("free", gripper)], [("carry", ball, gripper)]))
+    
+    as_bitsets = [tuple(catalogue.mask(atoms) for atoms in action) for action in actions]
+    as_sets = [tuple(frozenset(atoms) for atoms in action) for action in actions]
+    init = catalogue.init_state()
+    
+    def walk(state, actions, holds, apply):
+        rng = random.Random(0)
+        seen = set([state])
+        generated = 0
+        for _ in xrange(n_steps):
+            successors = []
+            for pre, add, delete in actions:
+                if holds(state, pre):
+                    successor = apply(state, add, delete)
+                    seen.add(successor)
+                    successors.append(successor)
+            generated += len(successors)
+            if successors:
+                state = rng.choice(successors)
+        return generated, len(seen)
+    
+    for label, state, actions, holds, apply in [
+            ("bitsets", init, as_bitsets, AtomCatalogue.holds, AtomCatalogue.apply),
+            ("frozensets", frozenset(catalogue.decode(init)), as_sets, lambda state, pre: pre <= state,
+                lambda state, add, delete: (state - delete) | add)]:
+        start = time.time()
+        generated, distinct = walk(state, actions, holds, apply)
+        elapsed = time.time() - start
+        print "==> %s: %d states (%d distinct) in %.3f s, %.0f states / s" % (label, generated, distinct, elapsed, generated / elapsed)
+
+def benchmark_grounding(n_balls=100, n_balls_large=5000):
+    '''Time grounding the sample gripper domain for a problem with n_balls balls, naively (every parameter over
+    every object, checking the preconditions on :init and its reachable facts), against the Grounder.
+    Then time the Grounder alone on n_balls_large balls.'''
+    
+    import itertools
+    
+    domain = Parser.get_tree(get_contents(f_domain))
+    problem = Parser.get_tree(make_gripper_problem(n_balls))
+    
+    # naive: only the static preconditions can be checked without a reachability analysis, so check those
+    grounder = Grounder(domain, problem)
+    facts = problem.get_facts()
+    objects = [SYMBOLS.id_of(name) for name in problem.get_objects()]
+    start = time.time()
+    naive = 0
+    for schema in grounder.schemas:
+        static = [atom for atom in schema.preconditions if atom[0] in grounder.static]
+        for args in itertools.product(objects, repeat=len(schema.parameters)):
+            if all(facts.has_ids(Grounder.ground_atom(atom, args)) for atom in static):
+                naive += 1
+    print "==> naive, %d balls: %d actions in %.3f s" % (n_balls, naive, time.time() - start)
+    
+    for n in [n_balls, n_balls_large]:
+        grounder = Grounder(domain, Parser.get_tree(make_gripper_problem(n)))
+        n_actions = sum(1 for _ in grounder.ground())
+        print "==> Grounder, %d balls: %d actions" % (n, n_actions)
+        print grounder.report()
+
+def benchmark_compiled_conditions(n_balls=50, n_states=200):
+    '''Time checking the preconditions (and applying the effects) of every ground action of a gripper problem
+    in n_states states, by walking the trees with the reference evaluator, against the compiled closures.'''
+    
+    import random
+    
+    domain = Parser.get_tree(get_contents(f_domain))
+    problem = Parser.get_tree(make_gripper_problem(n_balls))
+    grounder = Grounder(domain, problem)
+    ground = [(schema.name, tuple(SYMBOLS.names[arg] for arg in args)) for schema, args in
+        ((action.schema, action.args) for action in grounder.ground())]
+    catalogue = grounder.catalogue()
+    compiler = ConditionCompiler(catalogue)
+    actions = dict((action.get_action_name(), CompiledAction(action, compiler)) for action in domain.get_actions())
+    
+    start = time.time()
+    for name, args in ground:
+        actions[name].precondition(args)
+    print "==> compiled %d preconditions in %.3f s" % (len(ground), time.time() - start)
+    
+    # the states of a random walk
+    rng = random.Random(0)
+    states = [catalogue.init_state()]
+    while len(states) < n_states:
+        applicable = [(name, args) for name, args in ground if actions[name].applicable(states[-1], args)]
+        name, args = rng.choice(applicable)
+        states.append(actions[name].apply(states[-1], args))
+    as_sets = [set(catalogue.decode(state)) for state in states]
+    
+    start = time.time()
+    reference = [[evaluate(actions[name].precondition_tree, state, actions[name].binding(args), catalogue.types)
+        for name, args in ground] for state in as_sets]
+    reference_time = time.time() - start
+    
+    start = time.time()
+    compiled = [[actions[name].applicable(state, args) for name, args in ground] for state in states]
+    compiled_time = time.time() - start
+    
+    checks = len(ground) * len(states)
+    print "==> reference: %d checks in %.3f s, compiled: %.3f s (%.1fx), same results: %s" % (
+        checks, reference_time, compiled_time, reference_time / compiled_time, reference == compiled)
+    
+    start = time.time()
+    reference = [apply_effect(actions[name].effect_tree, state, actions[name].binding(args), catalogue.types)
+        for state, row in zip(as_sets, compiled) for (name, args), ok in zip(ground, row) if ok]
+    reference_time = time.time() - start
+    
+    start = time.time()
+    successors = [actions[name].apply(state, args) for state, row in zip(states, compiled) for (name, args), ok in zip(ground, row) if ok]
+    compiled_time = time.time() - start
+    
+    print "==> reference: %d effects in %.3f s, compiled: %.3f s (%.1fx), same results: %s" % (len(successors),
+        reference_time, compiled_time, reference_time / compiled_time, reference == [set(catalogue.decode(s)) for s in successors])
+
+def make_gripper_plan(balls, rng):
+    '''Return the text of a plan which takes the given balls from rooma to roomb (two at a time, in a random order).'''
+    
+    balls = list(balls)
+    rng.shuffle(balls)
+    steps = []
+    for i in xrange(0, len(balls), 2):
+        pair = zip(balls[i : i + 2], ["left", "right"])
+        steps.extend("(pick %s rooma %s)" % (ball, gripper) for ball, gripper in pair)
+        steps.append("(move rooma roomb)")
+        steps.extend("(drop %s roomb %s)" % (ball, gripper) for ball, gripper in pair)
+        steps.append("(move roomb rooma)")
+    return "\n".join(steps) + "\n"
+
+def benchmark_plan_validation(n_balls=20, n_plans=1000, n_shell=50):
+    '''Time validating n_plans plans (one in ten is broken) for a gripper problem with n_balls balls:
+    with one validator.py process per plan (like an external tool, on the first n_shell plans),
+    in this process with one PlanValidator, and on a pool of processes.'''
+    
+    import random
+    import shutil
+    import subprocess
+    import tempfile
+    
+    rng = random.Random(0)
+    directory = tempfile.mkdtemp()
+    f_problem = os.path.join(directory, "problem.pddl")
+    fp = open(f_problem, "w")
+    fp.write(make_gripper_problem(n_balls))
+    fp.close()
+    
+    balls = ["ball%d" % i for i in xrange(n_balls)]
+    f_plans = []
+    for i in xrange(n_plans):
+        plan = make_gripper_plan(balls, rng)
+        if i % 10 == 0:
+            # drop a step
+            steps = plan.split("\n")
+            del steps[rng.randrange(len(steps) - 1)]
+            plan = "\n".join(steps)
+        f_plans.append(os.path.join(directory, "plan%d.plan" % i))
+        fp = open(f_plans[-1], "w")
+        fp.write(plan)
+        fp.close()
+    
+    devnull = open(os.devnull, "w")
+    start = time.time()
+    for f_plan in f_plans[:n_shell]:
+        subprocess.call([sys.executable, "validator.py", f_domain, f_problem, f_plan], stdout=devnull)
+    elapsed = time.time() - start
+    print "==> one validator.py per plan: %d plans in %.3f s, %.1f plans / s" % (n_shell, elapsed, n_shell / elapsed)
+    
+    for label, processes in [("one PlanValidator", 1), ("pool of processes", None)]:
+        start = time.time()
+        summary = PlanValidator.validate_files(f_domain, f_problem, f_plans, processes)
+        elapsed = time.time() - start
+        print "==> %s: %d plans (%d passed, %d failed) in %.3f s, %.1f plans / s" % (label, n_plans,
+            summary["passed"], summary["failed"], elapsed, n_plans / elapsed)
+    
+    shutil.rmtree(directory)
 
 ###########################################################
 #    Specify constants here:                              #
@@ -81,4 +808,25 @@ f_domain = "samples/gripper-domain.pddl"
 
 profile_tree(f_problem)
 #show_domain(f_domain)
-#benchmark_seek_all()
\ No newline at end of file
+#benchmark_seek_all()
+#benchmark_nesting_depth()
+#benchmark_node_memory()
+#benchmark_backend_memory()
+#benchmark_symbol_interning()
+#benchmark_child_index()
+#benchmark_streaming()
+#benchmark_mapped_input()
+#benchmark_lazy_sections()
+#benchmark_serialize()
+#benchmark_incremental_serialize()
+#benchmark_shared_ornaments()
+#benchmark_hashcons()
+#benchmark_fingerprint()
+#benchmark_tree_diff()
+#benchmark_compare_dirs()
+#benchmark_parse_cache()
+#benchmark_fact_store()
+#benchmark_bitset_states()
+#benchmark_grounding()
+#benchmark_compiled_conditions()
+#benchmark_plan_validation()
\ No newline at end of file
@@ -4,19 +4,26 @@
 ################################
 
 from lisp_utils import LispParser
+from parse_cache import ParseCache
+from query import Query
 from utils import get_contents
-from sconvert import partition_translator_output
+from sconvert import split_translator_output, write_sections
+from multiprocessing import Pool
+import traceback
 import sys
 import os
 
+# the parse cache named by the LISP_PARSE_CACHE environment variable, if any
+PARSE_CACHE = ParseCache.from_environment()
+
 class TreeHanger(object):
 	''' This class intelligently adds content to the domain and problem files, which are fed into the HTN Planner.
 	The content to be added comes from Jorge's translator.
 	
 	The mechanism:
-		- seperate constituent parts of Jorge's translator output into 4 files using Shirin's script
+		- seperate constituent parts of Jorge's translator output into 4 sections using Shirin's script
 		- convert problem and domain files into trees
-		- convert 4 files into trees (call these ornaments)
+		- convert 4 sections into trees (call these ornaments), each only once
 		- copy and hang the 4 ornaments onto the problem and domain trees
 		
 	Unfortunately, there may be issues with larger files, because:
@@ -26,29 +33,93 @@ class TreeHanger(object):
 	I couldn't think of a good name for this class, put I keep thinking of hanging ornaments on Christmas trees.
 	'''
 	
-	def __init__(self, f_domain, f_problem, f_translator_out, problem_number=1):
-		'''Create a new tree hanger for the given set of files.'''
+	def __init__(self, f_domain, f_problem, f_translator_out, problem_number=1, flat=False, debug_files=False, domain_tree=None):
+		'''Create a new tree hanger for the given set of files.
+		If flat is set, the trees are stored with the flat_tree backend, which is lighter on memory.
+		If debug_files is set, the 4 sections of the translator output are also written to files, like sconvert does.
+		If domain_tree is given, it's used (and modified) instead of parsing f_domain, e.g. a copy of an already-parsed domain.'''
 		
 		self.f_domain = f_domain
 		self.f_problem = f_problem
 		self.p_num = problem_number
+		self.flat = flat
+		self.domain_tree = domain_tree
+		
+		# seperate the translator output into 4 sections, in memory
+		self.sections = split_translator_output(f_translator_out)
+		# the files the sections were written to (see sconvert.write_sections), or None
+		self.tr_outfiles = write_sections(f_translator_out, self.sections) if debug_files else None
+		
+		# section -> its tree, parsed on demand by ornaments
+		self._ornaments = {}
 		
-		# seperate the translator output into 4 files
-		self.tr_outfiles = partition_translator_output(f_translator_out)
+	def ornaments(self, sections):
+		'''Return a dictionary with the trees of the given sections of the translator output.
+		Each section is only parsed once, so the problem and domain share the same axiom tree.'''
+		
+		for section in sections:
+			if section not in self._ornaments:
+				self._ornaments[section] = LispParser.get_tree(self.sections[section], self.flat)
+		
+		return dict((section, self._ornaments[section]) for section in sections)
 		
 	def modify_problem(self):
 		'''Modify the problem file. Wrapper for the static method.'''
 		
 		problem_out = "Problem%d.lisp" % self.p_num
-		TreeHanger._modify_problem(self.f_problem, problem_out, self.tr_outfiles)
+		ornaments = self.ornaments(["init_states", "axioms"])
+		TreeHanger._modify_problem(self.f_problem, problem_out, ornaments, self.flat)
 		return problem_out
 		
 	def modify_domain(self):
 		'''Modify the domain file. Wrapper for the static method.'''
 		
 		domain_out = "Domain%d.lisp" % self.p_num
-		TreeHanger._modify_domain(self.f_domain, domain_out, self.tr_outfiles)
+		ornaments = self.ornaments(["add_effects", "del_effects", "axioms"])
+		TreeHanger._modify_domain(self.f_domain, domain_out, ornaments, self.flat, self.domain_tree)
 		return domain_out
+		
+	@staticmethod
+	def read_manifest(f_manifest):
+		'''Read a batch manifest. Each line has a problem file, a translator output file and a problem number,
+		seperated by whitespace. Blank lines and lines starting with # are skipped.
+		Return a list of (problem file, translator output file, problem number) tuples.'''
+		
+		items = []
+		
+		for line_num, line in enumerate(open(f_manifest), 1):
+			line = line.strip()
+			if not line or line.startswith("#"):
+				continue
+			
+			fields = line.split()
+			if len(fields) != 3:
+				raise ValueError("%s:%d: expected problem_file translator_output_file problem_number" % (f_manifest, line_num))
+			items.append((fields[0], fields[1], int(fields[2])))
+		
+		return items
+		
+	@staticmethod
+	def run_batch(f_domain, items, processes=None, flat=False):
+		'''Modify the domain and problem for every (problem file, translator output file, problem number) in items,
+		on a pool of processes (one per CPU by default). The domain is parsed once, before the workers start,
+		so a domain which can't be parsed raises here, instead of failing every worker.
+		Output files are named like for a single run (Problem%d.lisp and Domain%d.lisp).
+		A failed item doesn't stop the batch.
+		Return a list of (problem number, domain_out, problem_out, error) tuples, in the same order as items.
+		error is None for items that worked, and the traceback otherwise (and the file names are None).'''
+		
+		domain_tree = LispParser.get_tree(get_contents(f_domain), flat, cache=PARSE_CACHE)
+		
+		# the workers are forked, so they all get the parsed domain
+		pool = Pool(processes, _init_batch_worker, (domain_tree, flat))
+		try:
+			results = pool.map(_run_batch_item, items, 1)
+		finally:
+			pool.close()
+			pool.join()
+		
+		return results
 
 	@staticmethod
 	def add_init_state_prefs(problem_tree, pref_tree):
@@ -68,9 +139,11 @@ class TreeHanger(object):
 		
 		i = problem_tree.index_of(metric_tree)
 		
-		for f_i, function in enumerate(function_names):
-			path = ["defun", function]
-			subtree = axiom_tree.seek(path)
+		# find all the functions in one go
+		paths = [["defun", function] for function in function_names]
+		subtrees = Query.compile(paths).first(axiom_tree)
+		
+		for f_i, (function, subtree) in enumerate(zip(function_names, subtrees)):
 			if subtree:
 				subtree = subtree.parent
 				problem_tree.add_child(subtree, i + f_i) # not merge, since these do not have root node
@@ -79,30 +152,24 @@ class TreeHanger(object):
 				print "==> failed at " + function
 				
 	@staticmethod
-	def _modify_problem(f_problem, f_out, tr_outfiles):
+	def _modify_problem(f_problem, f_out, ornaments, flat=False):
 		'''Modify the problem by writing it to a new file.
+		ornaments has the trees of the "init_states" and "axioms" sections of the translator output.
 		Return the name of the new problem file.'''
 		
-		f_init_states = tr_outfiles["init_states"]
-		f_axioms = tr_outfiles["axioms"]
-		
 		# the problem
 		problem = get_contents(f_problem)
-		problem_tree = LispParser.get_tree(problem)
+		problem_tree = LispParser.get_tree(problem, flat, cache=PARSE_CACHE)
 		
 		# the preferences
-		init_states = get_contents(f_init_states)
-		init_states_tree = LispParser.get_tree(init_states)
-		TreeHanger.add_init_state_prefs(problem_tree, init_states_tree)
+		TreeHanger.add_init_state_prefs(problem_tree, ornaments["init_states"])
 		
 		# the axioms
-		axioms = get_contents(f_axioms)
-		axiom_tree = LispParser.get_tree(axioms)
-		TreeHanger.add_metric_functions(problem_tree, axiom_tree)
+		TreeHanger.add_metric_functions(problem_tree, ornaments["axioms"])
 		
 		# write to the new problem file
 		fp = open(f_out, "w")
-		fp.write(problem_tree.to_lisp())
+		problem_tree.write_lisp(fp)
 		fp.close()
 		
 		return f_out
@@ -115,10 +182,18 @@ class TreeHanger(object):
 		subtrees = domain_tree.seek_all(path)
 		
 		#del_effect_tree.print_tree()
+		
+		# the same effects go on every operator, so share them instead of re-parenting (or copying) them every time
+		del_effect_tree.freeze()
+		add_effect_tree.freeze()
+		
+		# the del-effects and add-effects of an operator
+		effects = Query.compile([[("eval", 1)], [("eval", 2)]])
 	
 		for i, subtree in enumerate(subtrees):
-			subtree.seek([("eval", 1)]).merge_tree(del_effect_tree)
-			subtree.seek([("eval", 2)]).merge_tree(add_effect_tree)
+			del_effects, add_effects = effects.first(subtree)
+			del_effects.merge_tree(del_effect_tree)
+			add_effects.merge_tree(add_effect_tree)
 	
 	@staticmethod
 	def add_domain_prefs(domain_tree, pref_tree):
@@ -132,36 +207,106 @@ class TreeHanger(object):
 			domain_subtree.add_child(subtree)
 	
 	@staticmethod
-	def _modify_domain(f_domain, f_out, tr_outfiles):
-		'''Create a new domain file. Return the name of the new file.'''
-		
-		f_add_effects= tr_outfiles["add_effects"]
-		f_del_effects= tr_outfiles["del_effects"]
-		f_axioms = tr_outfiles["axioms"]
+	def _modify_domain(f_domain, f_out, ornaments, flat=False, domain_tree=None):
+		'''Create a new domain file.
+		ornaments has the trees of the "add_effects", "del_effects" and "axioms" sections of the translator output.
+		If domain_tree is given, it is modified instead of parsing f_domain.
+		Return the name of the new file.'''
 		
 		# the domain
-		domain = get_contents(f_domain)
-		domain_tree = LispParser.get_tree(domain)
+		if domain_tree is None:
+			domain = get_contents(f_domain)
+			domain_tree = LispParser.get_tree(domain, flat, cache=PARSE_CACHE)
 		
 		# add and del effects
-		add_effects_tree = LispParser.get_tree(get_contents(f_add_effects))
-		del_effects_tree = LispParser.get_tree(get_contents(f_del_effects))
-		TreeHanger.add_add_del_effects(domain_tree, add_effects_tree, del_effects_tree)
+		TreeHanger.add_add_del_effects(domain_tree, ornaments["add_effects"], ornaments["del_effects"])
 		
 		# domain prefs
-		axioms = get_contents(f_axioms)
-		axiom_tree = LispParser.get_tree(axioms)
-		TreeHanger.add_domain_prefs(domain_tree, axiom_tree)
+		TreeHanger.add_domain_prefs(domain_tree, ornaments["axioms"])
 		
 		# write to the new domain file
 		fp = open(f_out, "w")
-		fp.write(domain_tree.to_lisp())
+		domain_tree.write_lisp(fp)
 		fp.close()
 		
 		return f_out
 
+# the domain of a batch, parsed once by each worker process
+_batch_domain = None
+_batch_flat = False
+
+def _init_batch_worker(domain_tree, flat):
+	'''Keep the parsed domain of the batch in a new worker process.'''
+	
+	global _batch_domain, _batch_flat
+	_batch_domain = domain_tree
+	_batch_flat = flat
+	
+def _run_batch_item(item):
+	'''Modify the domain and problem for one (problem file, translator output file, problem number) of a batch.
+	Return (problem number, domain_out, problem_out, error), see TreeHanger.run_batch.'''
+	
+	f_problem, f_translator_out, problem_number = item
+	domain_out = None
+	
+	try:
+		# modifying the domain changes it, so every item gets its own copy
+		hanger = TreeHanger(None, f_problem, f_translator_out, problem_number, _batch_flat, domain_tree=_batch_domain.copy())
+		domain_out = hanger.modify_domain()
+		problem_out = hanger.modify_problem()
+		return (problem_number, domain_out, problem_out, None)
+	except Exception:
+		error = traceback.format_exc()
+		# don't leave the domain of a failed item next to the good ones
+		if domain_out is not None and os.path.exists(domain_out):
+			os.remove(domain_out)
+		return (problem_number, None, None, error)
+
+def batch_main(args):
+	'''Run a batch from the command line arguments: domain_file manifest_file [processes]'''
+	
+	usage = "usage: python tree_hanger.py --batch domain_file manifest_file [processes]"
+	
+	if not 2 <= len(args) <= 3:
+		print >>sys.stderr, usage
+		sys.exit(1)
+	
+	for f in args[:2]:
+		if not os.path.exists(f):
+			print >>sys.stderr, "Given file does not exist: '%s'" % f
+			sys.exit(1)
+	
+	f_domain, f_manifest = args[:2]
+	processes = int(args[2]) if len(args) == 3 else None
+	
+	items = TreeHanger.read_manifest(f_manifest)
+	print "==> Batch of %d problems against %s" % (len(items), f_domain)
+	
+	try:
+		results = TreeHanger.run_batch(f_domain, items, processes)
+	except Exception:
+		print >>sys.stderr, "==> Could not read the domain:"
+		print >>sys.stderr, traceback.format_exc()
+		sys.exit(1)
+	
+	failed = 0
+	for problem_number, domain_out, problem_out, error in results:
+		if error is None:
+			print "==> Problem %d: wrote %s and %s" % (problem_number, domain_out, problem_out)
+		else:
+			failed += 1
+			print >>sys.stderr, "==> Problem %d failed:" % problem_number
+			print >>sys.stderr, error
+	
+	print "==> %d done, %d failed" % (len(items) - failed, failed)
+	sys.exit(1 if failed else 0)
+
 if __name__ == "__main__":
-	usage = "usage: python tree_hanger.py domain_file problem_file transator_output_file [problem_number]"
+	if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+		batch_main(sys.argv[2:])
+	
+	usage = "usage: python tree_hanger.py domain_file problem_file transator_output_file [problem_number]\n" \
+		"       python tree_hanger.py --batch domain_file manifest_file [processes]"
 	
 	if not 4 <= len(sys.argv) <= 5:
 		if len(sys.argv) < 4:
@@ -179,7 +324,7 @@ if __name__ == "__main__":
 			
 	f_domain, f_problem, f_translator_output = sys.argv[1:4]
 	
-	if len(sys.argv) == 4:
+	if len(sys.argv) == 5:
 		problem_number = int(sys.argv[-1])
 	else:
 		problem_number = 1
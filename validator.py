@@ -0,0 +1,283 @@
+''' Validates plans against a PDDL domain and problem '''
+
+from pddl_utils import PDDLParser
+from parse_cache import ParseCache
+from states import AtomCatalogue, typed_list, list_names, type_name, conjuncts, section_after
+from conditions import ConditionCompiler, CompiledAction, evaluate
+from utils import get_contents
+from multiprocessing import Pool, cpu_count
+import fnmatch
+import json
+import re
+import sys
+import os
+
+# the parse cache named by the LISP_PARSE_CACHE environment variable, if any
+PARSE_CACHE = ParseCache.from_environment()
+
+class PlanValidator(object):
+	'''Validates plans (sequences of ground actions) for one domain and problem:
+		- every step must name an action of the domain, with objects of the right types as arguments
+		- its precondition must hold in the state before it, and its effect makes the next state
+		- the goal must hold after the last step
+	The states are AtomCatalogue bitsets, and the preconditions, effects and goal are compiled (see conditions.py).
+	Compiled actions are kept, so validating many plans with one validator only compiles each ground action once.
+	Names in plans are matched without regard to case, like in PDDL.'''
+
+	# a step of a plan, like (pick ball1 rooma left); step numbers (0:) and durations ([1]) around it are ignored
+	STEP_RE = re.compile(r"\(\s*([^()\s]+)((?:\s+[^()\s]+)*)\s*\)")
+
+	# a variable, in the text of a condition
+	_VARIABLE_RE = re.compile(r"\?[^\s()]+")
+
+	# plan files are found with this pattern, in a --batch directory
+	DIR_PATTERN = "*.plan"
+
+	def __init__(self, domain_tree, problem_tree):
+		'''Build the validator for the given (parsed) domain and problem.'''
+
+		self.catalogue = AtomCatalogue(domain_tree, problem_tree)
+		self.compiler = ConditionCompiler(self.catalogue)
+
+		# lower case action name -> CompiledAction
+		self.actions = {}
+		# lower case action name -> the types of its parameters
+		self.parameter_types = {}
+		for action in domain_tree.get_actions():
+			compiled = CompiledAction(action, self.compiler)
+			self.actions[compiled.name.lower()] = compiled
+			parameters = section_after(action, ":parameters")
+			parameters = typed_list(list_names(parameters)) if parameters is not None else []
+			self.parameter_types[compiled.name.lower()] = [t for _, t in parameters]
+
+		# lower case object name -> (object name, type)
+		self.objects = dict((name.lower(), (name, t)) for name, t in self.catalogue.objects)
+
+		self.init = self.catalogue.init_state()
+		goal = problem_tree.get_goal()
+		self.goal_tree = goal.children[0] if goal and goal.children else None
+		self.goal = self.compiler.condition(self.goal_tree, {})
+
+	@staticmethod
+	def from_files(f_domain, f_problem):
+		'''Return the validator for the given domain and problem files.'''
+
+		return PlanValidator(PDDLParser.get_tree(get_contents(f_domain), cache=PARSE_CACHE),
+			PDDLParser.get_tree(get_contents(f_problem), cache=PARSE_CACHE))
+
+	@staticmethod
+	def parse_plan(text):
+		'''Return the steps of the given plan text, as a list of (line number, action name, tuple of argument names).
+		Comments (from ; to the end of the line) are skipped.'''
+
+		steps = []
+		for line_num, line in enumerate(text.split("\n"), 1):
+			line = line.split(";", 1)[0]
+			for match in PlanValidator.STEP_RE.finditer(line):
+				steps.append((line_num, match.group(1), tuple(match.group(2).split())))
+		return steps
+
+	@staticmethod
+	def _failure(steps, i, reason):
+		'''Return the result for a plan (a list of steps) which fails at step i (or at the goal, for i == len(steps)).'''
+
+		result = {"status" : "invalid", "passed" : False, "steps" : len(steps), "step" : i, "reason" : reason}
+		if i < len(steps):
+			line_num, name, args = steps[i]
+			result["line"] = line_num
+			result["action"] = "(%s)" % " ".join((name, ) + args)
+		return result
+
+	def _unsatisfied(self, action, args, state):
+		'''Return the parts of the action's precondition which don't hold in the given state, to explain a failure.
+		They are text, with the parameters replaced by the arguments, like (free left).'''
+
+		binding = action.binding(args)
+		atoms = set(self.catalogue.decode(state))
+		unsatisfied = []
+		for part in conjuncts(action.precondition_tree):
+			if not evaluate(part, atoms, binding, self.catalogue.types):
+				text = " ".join(part.to_lisp().split()).replace("( ", "(").replace(" )", ")")
+				unsatisfied.append(PlanValidator._VARIABLE_RE.sub(lambda match: binding.get(match.group(), match.group()), text))
+		return unsatisfied
+
+	def validate(self, steps):
+		'''Validate the given steps (from parse_plan). Return a dictionary with:
+			status - "valid", or "invalid"
+			passed - True iff the plan is valid
+			steps - how many steps the plan has
+		and for invalid plans, the first step which fails:
+			step - its position (from 0), or the number of steps if the goal doesn't hold at the end
+			reason - why it fails
+			line, action - its line in the plan text, and the step as it's written (not for the goal)'''
+
+		state = self.init
+
+		for i, (line_num, name, args) in enumerate(steps):
+			action = self.actions.get(name.lower())
+			if action is None:
+				return self._failure(steps, i, "unknown action")
+
+			types = self.parameter_types[name.lower()]
+			if len(args) != len(types):
+				return self._failure(steps, i, "takes %d arguments, not %d" % (len(types), len(args)))
+
+			objects = []
+			for arg, t in zip(args, types):
+				found = self.objects.get(arg.lower())
+				if found is None:
+					return self._failure(steps, i, "unknown object %s" % arg)
+				if not self.catalogue.types.is_a(found[1], t):
+					return self._failure(steps, i, "%s is a %s, not a %s" % (arg, type_name(found[1]), type_name(t)))
+				objects.append(found[0])
+			objects = tuple(objects)
+
+			if not action.applicable(state, objects):
+				return self._failure(steps, i,
+					"precondition does not hold: %s" % " ".join(self._unsatisfied(action, objects, state)))
+			state = action.apply(state, objects)
+
+		if not self.goal(state):
+			return self._failure(steps, len(steps), "goal does not hold after the last step")
+
+		return {"status" : "valid", "passed" : True, "steps" : len(steps)}
+
+	def validate_text(self, text):
+		'''Validate the given plan text, see validate.'''
+
+		return self.validate(PlanValidator.parse_plan(text))
+
+	def validate_file(self, f_plan):
+		'''Validate the given plan file, see validate.
+		Errors (like a file which can't be read) give the status "error", and error, the message.'''
+
+		try:
+			return self.validate_text(get_contents(f_plan))
+		except Exception as e:
+			return {"status" : "error", "passed" : False, "error" : "%s: %s" % (type(e).__name__, e)}
+
+	@staticmethod
+	def validate_files(f_domain, f_problem, f_plans, processes=None):
+		'''Validate every plan file in f_plans against the given domain and problem, on a pool of processes
+		(one per CPU by default; 1 validates in this process). The validator is made once, before the workers start,
+		and each worker keeps the compiled actions for all of its plans. If the domain and problem can't be read,
+		every plan gets the status "error", like in validate_file.
+		Return a summary dictionary, which can be written out as JSON:
+			domain, problem - the files
+			passed, failed - how many plans passed and failed
+			plans - a list with a dictionary per plan: plan (the file), and the result of validate_file.'''
+
+		try:
+			validator = PlanValidator.from_files(f_domain, f_problem)
+		except Exception as e:
+			error = "%s: %s" % (type(e).__name__, e)
+			results = [{"status" : "error", "passed" : False, "error" : error} for f_plan in f_plans]
+		else:
+			if processes == 1:
+				results = [validator.validate_file(f_plan) for f_plan in f_plans]
+			else:
+				results = PlanValidator._validate_on_pool(validator, f_plans, processes or cpu_count())
+
+		for f_plan, result in zip(f_plans, results):
+			result["plan"] = f_plan
+		passed = sum(1 for result in results if result["passed"])
+
+		return {
+			"domain" : f_domain,
+			"problem" : f_problem,
+			"passed" : passed,
+			"failed" : len(results) - passed,
+			"plans" : results
+		}
+
+	@staticmethod
+	def _validate_on_pool(validator, f_plans, processes):
+		'''Return the results of validate_file for every plan file, on a pool of the given number of processes.'''
+
+		# the workers are forked, so they all get the validator
+		pool = Pool(processes, _init_validate_worker, (validator, ))
+		try:
+			# plans are quick to validate, so hand them out in chunks
+			results = pool.map(_validate_plan, f_plans, max(1, len(f_plans) // (processes * 4)))
+		finally:
+			pool.close()
+			pool.join()
+		return results
+
+# the validator of a batch, in each worker process
+_batch_validator = None
+
+def _init_validate_worker(validator):
+	'''Keep the validator of the batch in a new worker process.'''
+
+	global _batch_validator
+	_batch_validator = validator
+
+def _validate_plan(f_plan):
+	'''Validate one plan file of a batch in a worker process, see PlanValidator.validate_files.'''
+
+	return _batch_validator.validate_file(f_plan)
+
+def batch_main(args):
+	'''Validate many plans from the command line arguments: domain_file problem_file plan_dir [summary_file] [processes]
+	The plans are the files in plan_dir which match PlanValidator.DIR_PATTERN. The JSON summary goes to summary_file, or stdout.'''
+
+	usage = "usage: python validator.py --batch domain_file problem_file plan_dir [summary_file] [processes]"
+
+	if not 3 <= len(args) <= 5:
+		print >>sys.stderr, usage
+		sys.exit(1)
+
+	for f in args[:2]:
+		if not os.path.exists(f):
+			print >>sys.stderr, "Given file does not exist: '%s'" % f
+			sys.exit(1)
+	if not os.path.isdir(args[2]):
+		print >>sys.stderr, "Given directory does not exist: '%s'" % args[2]
+		sys.exit(1)
+
+	f_plans = [os.path.join(args[2], f) for f in sorted(fnmatch.filter(os.listdir(args[2]), PlanValidator.DIR_PATTERN))]
+	processes = int(args[4]) if len(args) == 5 else None
+	summary = PlanValidator.validate_files(args[0], args[1], f_plans, processes)
+
+	if len(args) >= 4:
+		fp = open(args[3], "w")
+		json.dump(summary, fp, indent=2, sort_keys=True)
+		fp.close()
+		print "==> %d passed, %d failed, summary in %s" % (summary["passed"], summary["failed"], args[3])
+	else:
+		print json.dumps(summary, indent=2, sort_keys=True)
+
+	sys.exit(1 if summary["failed"] else 0)
+
+if __name__ == "__main__":
+	if len(sys.argv) > 1 and sys.argv[1] == "--batch":
+		batch_main(sys.argv[2:])
+
+	usage = "usage: python validator.py domain_file problem_file plan_file\n" \
+		"       python validator.py --batch domain_file problem_file plan_dir [summary_file] [processes]"
+
+	if len(sys.argv) != 4:
+		if len(sys.argv) < 4:
+			print >>sys.stderr, "Too few arguments"
+		else:
+			print >>sys.stderr, "Too many arguments"
+		print >>sys.stderr, usage
+		sys.exit(1)
+
+	for f in sys.argv[1:]:
+		if not os.path.exists(f):
+			print >>sys.stderr, "Given file does not exist: '%s'" % f
+			sys.exit(1)
+
+	f_domain, f_problem, f_plan = sys.argv[1:]
+	result = PlanValidator.from_files(f_domain, f_problem).validate_file(f_plan)
+
+	if result["passed"]:
+		print "==> Plan valid, %d steps" % result["steps"]
+	elif result["status"] == "error":
+		print "==> Plan could not be validated: %s" % result["error"]
+	else:
+		print "==> Plan invalid at step %d%s: %s" % (result["step"],
+			(" (line %d, %s)" % (result["line"], result["action"])) if "line" in result else "", result["reason"])
+	sys.exit(0 if result["passed"] else 1)